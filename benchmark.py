@@ -0,0 +1,478 @@
+import os
+import sys
+import math
+import csv
+import json
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import logging
+import platform
+import tempfile
+from xml.sax.saxutils import escape
+from database import create_database, connect
+from converters import convert_file, get_markitdown
+from tokenizer import (create_index, open_index, get_writer, add_document_to_index, segment_content,
+                       SearcherPool, parse_query, query_schema)
+from indexer import (scan_folders, attributes_to_row, load_indexed_fingerprints, fingerprint_changed)
+from startup import load_jieba
+from whoosh.qparser import QueryParser
+
+
+# 生成测试文本使用的词汇，中英文混合
+CHINESE_WORDS = [
+    "数据", "索引", "搜索", "文件", "系统", "服务器", "网络", "用户", "项目", "管理",
+    "分析", "报告", "会议", "计划", "市场", "产品", "客户", "财务", "预算", "合同",
+    "北京", "上海", "广州", "深圳", "中华人民共和国", "人工智能", "机器学习", "数据库", "云计算", "安全",
+    "开发", "测试", "部署", "运维", "文档", "设计", "需求", "质量", "性能", "效率",
+]
+ENGLISH_WORDS = [
+    "data", "index", "search", "file", "system", "server", "network", "user", "project", "report",
+    "meeting", "market", "product", "customer", "budget", "contract", "python", "whoosh", "query", "cache",
+]
+
+# 默认生成的文件数量
+DEFAULT_COUNTS = "md=200,csv=50,docx=20,xlsx=20"
+
+
+# 生成大约 size 个字符的中英文混合文本
+def random_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(CHINESE_WORDS) if rng.random() < 0.7 else rng.choice(ENGLISH_WORDS)
+        words.append(word)
+        length += len(word) + 1
+        if rng.random() < 0.08:
+            words.append("。\n" if rng.random() < 0.5 else "，")
+    return " ".join(words)
+
+
+def write_markdown(path, rng, size):
+    paragraphs = []
+    while sum(len(paragraph) for paragraph in paragraphs) < size:
+        paragraphs.append(f"## {random_text(rng, 12)}\n\n{random_text(rng, 400)}")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(f"# {random_text(rng, 16)}\n\n" + "\n\n".join(paragraphs) + "\n")
+
+
+def write_csv(path, rng, size):
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["id", "name", "city", "note"])
+        written = 0
+        row_id = 0
+        while written < size:
+            row = [row_id, random_text(rng, 8), rng.choice(CHINESE_WORDS[20:24]), random_text(rng, 60)]
+            writer.writerow(row)
+            written += sum(len(str(cell)) for cell in row)
+            row_id += 1
+
+
+# 只包含正文的最小 docx，不依赖 python-docx
+def write_docx(path, rng, size):
+    paragraphs = []
+    written = 0
+    while written < size:
+        text = random_text(rng, 300)
+        paragraphs.append(f"<w:p><w:r><w:t>{escape(text)}</w:t></w:r></w:p>")
+        written += len(text)
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+        + "".join(paragraphs) + "</w:body></w:document>"
+    )
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        "</Types>"
+    )
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="word/document.xml"/></Relationships>'
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", content_types)
+        archive.writestr("_rels/.rels", rels)
+        archive.writestr("word/document.xml", document)
+
+
+def write_xlsx(path, rng, size):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    sheet.append(["id", "name", "city", "note"])
+    written = 0
+    row_id = 0
+    while written < size:
+        row = [row_id, random_text(rng, 8), rng.choice(CHINESE_WORDS[20:24]), random_text(rng, 60)]
+        sheet.append(row)
+        written += sum(len(str(cell)) for cell in row)
+        row_id += 1
+    workbook.save(path)
+
+
+# 扩展名与生成函数的对应关系
+GENERATORS = {
+    ".md": write_markdown,
+    ".csv": write_csv,
+    ".docx": write_docx,
+    ".xlsx": write_xlsx,
+}
+
+
+# 解析 md=200,csv=50 形式的文件数量
+def parse_counts(value):
+    counts = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        extension, _, count = item.partition("=")
+        extension = "." + extension.strip().lstrip(".").lower()
+        if extension not in GENERATORS:
+            raise argparse.ArgumentTypeError(f"Unsupported extension: {extension}")
+        counts[extension] = int(count)
+    return counts
+
+
+# 在 directory 下生成测试文件，每个子目录最多 100 个文件，文件大小在 size 的 0.5 到 1.5 倍之间
+# 相同的 seed 生成相同的内容
+def generate_corpus(directory, counts, size, seed):
+    rng = random.Random(seed)
+    paths = []
+    for extension, count in counts.items():
+        for number in range(count):
+            subdir = os.path.join(directory, extension[1:], f"{number // 100:03d}")
+            os.makedirs(subdir, exist_ok=True)
+            path = os.path.join(subdir, f"doc{number:05d}{extension}")
+            GENERATORS[extension](path, rng, int(size * rng.uniform(0.5, 1.5)))
+            paths.append(path)
+    return paths
+
+
+# 生成查询：单个中文词、单个英文词和两个词的组合
+def generate_queries(count, seed):
+    rng = random.Random(seed + 1)
+    queries = []
+    for number in range(count):
+        kind = number % 3
+        if kind == 0:
+            queries.append(rng.choice(CHINESE_WORDS))
+        elif kind == 1:
+            queries.append(rng.choice(ENGLISH_WORDS))
+        else:
+            queries.append(f"{rng.choice(CHINESE_WORDS)} {rng.choice(CHINESE_WORDS + ENGLISH_WORDS)}")
+    return queries
+
+
+# 按最近秩法计算百分位数
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# 汇总一个阶段的结果，latencies 为每项的耗时（秒），nbytes 为处理的字节数
+def summarize(count, seconds, latencies=None, nbytes=None, unit="files"):
+    result = {
+        "count": count,
+        "seconds": round(seconds, 6),
+        f"{unit}_per_s": round(count / seconds, 3) if seconds else 0.0,
+    }
+    if nbytes is not None:
+        result["mb"] = round(nbytes / 1024 / 1024, 3)
+        result["mb_per_s"] = round(nbytes / 1024 / 1024 / seconds, 3) if seconds else 0.0
+    if latencies:
+        result["p50_ms"] = round(percentile(latencies, 50) * 1000, 3)
+        result["p99_ms"] = round(percentile(latencies, 99) * 1000, 3)
+        result["max_ms"] = round(max(latencies) * 1000, 3)
+    return result
+
+
+# 扫描：与全量索引相同的并行目录扫描
+def bench_scan(directory, workers):
+    started = time.perf_counter()
+    attributes = [attr for batch in scan_folders([directory], workers, 1000, 10) for attr in batch]
+    seconds = time.perf_counter() - started
+    nbytes = sum(attr["file_size"] for attr in attributes)
+    return attributes, summarize(len(attributes), seconds, nbytes=nbytes)
+
+
+# 解析：逐个文件在当前进程中转换，按扩展名分别统计
+def bench_parse(attributes):
+    contents = {}
+    latencies = []
+    by_extension = {}
+    started = time.perf_counter()
+    for attr in attributes:
+        file_started = time.perf_counter()
+        content = convert_file(attr["file_path"], attr["extension"])
+        elapsed = time.perf_counter() - file_started
+        latencies.append(elapsed)
+        by_extension.setdefault(attr["extension"].lower(), []).append((elapsed, attr["file_size"]))
+        if content is not None:
+            contents[attr["file_path"]] = (attr["file_name"], content)
+    seconds = time.perf_counter() - started
+    result = summarize(len(attributes), seconds, latencies, sum(attr["file_size"] for attr in attributes))
+    result["failed"] = len(attributes) - len(contents)
+    result["by_extension"] = {
+        extension: summarize(len(items), sum(item[0] for item in items), [item[0] for item in items],
+                             sum(item[1] for item in items))
+        for extension, items in sorted(by_extension.items())
+    }
+    return contents, result
+
+
+# 分词：与索引进程相同的 segment_content
+def bench_segment(contents):
+    segmented = {}
+    latencies = []
+    nbytes = 0
+    started = time.perf_counter()
+    for file_path, (file_name, content) in contents.items():
+        item_started = time.perf_counter()
+        segmented[file_path] = (file_name, segment_content(file_name, content))
+        latencies.append(time.perf_counter() - item_started)
+        nbytes += len(content.encode("utf-8"))
+    seconds = time.perf_counter() - started
+    return segmented, summarize(len(contents), seconds, latencies, nbytes)
+
+
+# 写入索引：单个 writer 写入全部文档后提交，提交时间计入总耗时
+def bench_index(index_dir, segmented, limitmb):
+    ix = create_index(index_dir)
+    nbytes = 0
+    latencies = []
+    started = time.perf_counter()
+    writer = get_writer(ix, limitmb=limitmb)
+    for file_path, (file_name, segmented_content) in segmented.items():
+        item_started = time.perf_counter()
+        add_document_to_index(writer, file_path, file_name, None, segmented_content)
+        latencies.append(time.perf_counter() - item_started)
+        nbytes += len(segmented_content.encode("utf-8"))
+    commit_started = time.perf_counter()
+    writer.commit()
+    seconds = time.perf_counter() - started
+    result = summarize(len(segmented), seconds, latencies, nbytes, unit="docs")
+    result["commit_seconds"] = round(time.perf_counter() - commit_started, 6)
+    ix.close()
+    return result
+
+
+# 对比：全量扫描时读取已索引文件的指纹并逐个比较
+def bench_reconcile(db_path, attributes):
+    create_database(db_path)
+    with connect(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO indexed (file_path, file_name, extension, file_type, creation_time, modification_time, file_size, is_hidden, mtime_ns, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'indexed')",
+            [attributes_to_row(attr) for attr in attributes],
+        )
+        conn.commit()
+        started = time.perf_counter()
+        fingerprints = load_indexed_fingerprints(conn)
+        changed = sum(fingerprint_changed(fingerprints.pop(attr["file_path"]), attr) for attr in attributes)
+        seconds = time.perf_counter() - started
+    conn.close()
+    result = summarize(len(attributes), seconds)
+    result["changed"] = changed
+    return result
+
+
+# 搜索：与 searcher 相同的查询构造，不经过查询缓存
+def bench_search(index_dir, queries, limit):
+    ix = open_index(index_dir)
+    pool = SearcherPool(ix)
+    parser = QueryParser("file_content", query_schema())
+    latencies = []
+    hits = 0
+    started = time.perf_counter()
+    for query_str in queries:
+        query_started = time.perf_counter()
+        with pool.searcher() as searcher:
+            results = searcher.search(parse_query(query_str, parser), limit=limit)
+            # 与 search_content 一样读取存储的字段
+            hits += len([result["file_path"] for result in results])
+        latencies.append(time.perf_counter() - query_started)
+    seconds = time.perf_counter() - started
+    pool.close()
+    ix.close()
+    result = summarize(len(queries), seconds, latencies, unit="queries")
+    result["hits"] = hits
+    return result
+
+
+# 通过 Flask 测试客户端调用已部署的 searcher，测量 search_index 和 render_file
+# 使用 data 目录中现有的索引和数据库，每个文件只渲染一次，反映未命中渲染缓存时的耗时
+def bench_app(queries, render_count):
+    import searcher
+    client = searcher.app.test_client()
+    results = {}
+
+    latencies = []
+    started = time.perf_counter()
+    for query_str in queries:
+        searcher.query_cache.clear()
+        query_started = time.perf_counter()
+        client.get("/api/search", query_string={"q": query_str})
+        latencies.append(time.perf_counter() - query_started)
+    results["app_search"] = summarize(len(queries), time.perf_counter() - started, latencies, unit="queries")
+
+    paths = [row[0] for row in searcher.query_db(
+        "SELECT file_path FROM indexed ORDER BY file_path LIMIT ?", (render_count,), fetchall=True)]
+    latencies = []
+    nbytes = 0
+    started = time.perf_counter()
+    for number, file_path in enumerate(paths):
+        render_started = time.perf_counter()
+        response = client.get("/render_file", query_string={"path": file_path, "query": queries[number % len(queries)]})
+        nbytes += len(response.get_data())
+        latencies.append(time.perf_counter() - render_started)
+    results["app_render"] = summarize(len(paths), time.perf_counter() - started, latencies, nbytes)
+    return results
+
+
+# 运行全部阶段，返回可以保存为 JSON 的结果
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ctsearch-bench-")
+    corpus_dir = os.path.join(workdir, "corpus")
+    counts = parse_counts(args.files)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "files": counts,
+            "size_kb": args.size,
+            "queries": args.queries,
+            "seed": args.seed,
+        },
+        "stages": {},
+    }
+    stages = report["stages"]
+    try:
+        started = time.perf_counter()
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        generate_corpus(corpus_dir, counts, args.size * 1024, args.seed)
+        report["meta"]["generate_seconds"] = round(time.perf_counter() - started, 3)
+        report["meta"]["jieba_seconds"] = round(load_jieba(), 3)
+        # markitdown 在第一次解析 Office 文件时才导入，提前导入，不计入解析耗时
+        started = time.perf_counter()
+        get_markitdown()
+        report["meta"]["markitdown_seconds"] = round(time.perf_counter() - started, 3)
+
+        attributes, stages["scan"] = bench_scan(corpus_dir, args.scan_workers)
+        contents, stages["parse"] = bench_parse(attributes)
+        segmented, stages["segment"] = bench_segment(contents)
+        index_dir = os.path.join(workdir, "index_dir")
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.makedirs(index_dir)
+        stages["index"] = bench_index(index_dir, segmented, args.limitmb)
+        db_path = os.path.join(workdir, "index.db")
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        stages["reconcile"] = bench_reconcile(db_path, attributes)
+        queries = generate_queries(args.queries, args.seed)
+        stages["search"] = bench_search(index_dir, queries, args.limit)
+        if args.app:
+            stages.update(bench_app(queries, args.render_files))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+# 比较两次结果中各阶段的指标，吞吐量下降或延迟上升超过 threshold（百分比）时视为退化
+def compare_reports(baseline, current, threshold):
+    lines = []
+    regressions = []
+    for stage, metrics in current["stages"].items():
+        base_metrics = baseline.get("stages", {}).get(stage)
+        if not base_metrics:
+            continue
+        for metric, value in metrics.items():
+            base_value = base_metrics.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(base_value, (int, float)) or not base_value:
+                continue
+            if metric.endswith("_per_s"):
+                higher_is_better = True
+            elif metric.endswith("_ms"):
+                higher_is_better = False
+            else:
+                continue
+            change = (value - base_value) / base_value * 100
+            regressed = -change > threshold if higher_is_better else change > threshold
+            lines.append(f"{stage:12} {metric:16} {base_value:>12.3f} {value:>12.3f} {change:>+8.1f}%{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{stage}.{metric}")
+    return lines, regressions
+
+
+def load_report(path):
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="生成测试文件，测量扫描、解析、分词、索引、对比和搜索各阶段的性能")
+    parser.add_argument("--files", default=DEFAULT_COUNTS,
+                        help=f"各类文件的数量，默认 {DEFAULT_COUNTS}")
+    parser.add_argument("--size", type=int, default=20, help="文件的平均大小（KB，按字符计），默认 20")
+    parser.add_argument("--queries", type=int, default=300, help="搜索的查询数，默认 300")
+    parser.add_argument("--limit", type=int, default=50, help="每个查询取回的结果数，默认 50")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子，相同的种子生成相同的文件和查询")
+    parser.add_argument("--scan-workers", type=int, default=4, help="扫描目录的线程数，默认 4")
+    parser.add_argument("--limitmb", type=int, default=128, help="Whoosh writer 的内存上限（MB），默认 128")
+    parser.add_argument("--workdir", help="生成文件和索引的目录，默认使用临时目录并在结束后删除")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    parser.add_argument("--app", action="store_true",
+                        help="同时通过 searcher 测量 data 目录中现有索引的搜索和渲染")
+    parser.add_argument("--render-files", type=int, default=50, help="--app 时渲染的文件数，默认 50")
+    parser.add_argument("--output", help="将结果写入 JSON 文件，默认输出到标准输出")
+    parser.add_argument("--compare", nargs="+", metavar="JSON",
+                        help="与基准结果比较：只给一个文件时先运行测试再比较，给两个文件时直接比较")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="吞吐量下降或延迟上升超过该百分比时视为退化，默认 10")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # 索引函数会为每个文件输出日志，测试时只保留警告
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.getLogger("jieba").setLevel(logging.WARNING)
+
+    if args.compare and len(args.compare) > 2:
+        sys.exit("--compare accepts at most two files")
+    if args.compare and len(args.compare) == 2:
+        report = load_report(args.compare[1])
+    else:
+        report = run_benchmark(args)
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                file.write(output + "\n")
+        elif not args.compare:
+            print(output)
+
+    if args.compare:
+        lines, regressions = compare_reports(load_report(args.compare[0]), report, args.threshold)
+        print(f"{'stage':12} {'metric':16} {'baseline':>12} {'current':>12} {'change':>9}")
+        print("\n".join(lines))
+        if regressions:
+            print(f"Regressions over {args.threshold}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import os
+import sys
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存，记录命中和未命中次数。
+
+    每个 gunicorn worker 进程各自持有一份缓存。
+    maxbytes 大于 0 时同时按 sizeof 计算的总大小限制容量，单项超过 maxbytes 时不缓存。
+    """
+
+    def __init__(self, maxsize=256, maxbytes=0, sizeof=sys.getsizeof):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """
+        读取缓存，命中时将该项移到最近使用的位置。
+        """
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self.items[key]
+
+    def put(self, key, value):
+        """
+        写入缓存，超出容量时淘汰最久未使用的项。
+        """
+        if self.maxsize <= 0:
+            return
+        size = self.sizeof(value) if self.maxbytes > 0 else 0
+        if self.maxbytes > 0 and size > self.maxbytes:
+            return
+        with self.lock:
+            self.bytes -= self.sizes.pop(key, 0)
+            self.items[key] = value
+            self.items.move_to_end(key)
+            self.sizes[key] = size
+            self.bytes += size
+            while len(self.items) > self.maxsize or (self.maxbytes > 0 and self.bytes > self.maxbytes):
+                evicted, _ = self.items.popitem(last=False)
+                self.bytes -= self.sizes.pop(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        清空缓存，命中统计保留。
+        """
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        返回缓存的统计信息。
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "maxsize": self.maxsize,
+                "bytes": self.bytes,
+                "maxbytes": self.maxbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class GenerationCache(LRUCache):
+    """
+    与 Whoosh 索引版本绑定的 LRU 缓存。
+
+    索引器每次提交都会生成新的索引版本（generation），读取时发现版本变化就清空缓存。
+    """
+
+    def __init__(self, maxsize=256):
+        super().__init__(maxsize)
+        self.generation = None
+
+    def check_generation(self, generation):
+        """
+        索引版本变化时清空缓存。
+        """
+        if generation != self.generation:
+            if self.generation is not None:
+                self.clear()
+            self.generation = generation
+
+    def stats(self):
+        stats = super().stats()
+        stats["generation"] = self.generation
+        return stats
+
+
+class DiskCache:
+    """
+    保存在磁盘上的缓存，每项一个文件，多个 worker 进程共享。
+
+    读取时更新文件的修改时间，总大小超过 maxbytes 时删除最久未使用的文件。
+    """
+
+    # 每写入 x 次检查一次总大小
+    prune_every = 32
+
+    def __init__(self, directory, maxbytes):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        name = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        """
+        读取缓存的字节串，不存在时返回 None。
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        先写入临时文件再替换，其他进程不会读到写了一半的文件。
+        """
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Error writing disk cache {path}: {e}")
+            return
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """
+        删除最久未使用的文件，直到总大小不超过 maxbytes。
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stats = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, entry.path))
+                total += stats.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        返回缓存的统计信息。
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
@@ -0,0 +1,216 @@
+import io
+import re
+import csv
+import json
+import logging
+from html.parser import HTMLParser
+from defusedxml.ElementTree import iterparse, ParseError
+
+
+# 每个进程只创建一次 MarkItDown
+_markitdown = None
+
+
+def get_markitdown():
+    """
+    返回当前进程缓存的 MarkItDown 实例。
+    markitdown 及其依赖（pandas 等）导入较慢，第一次解析 Office 文件时才导入。
+    """
+    global _markitdown
+    if _markitdown is None:
+        from markitdown import MarkItDown
+        _markitdown = MarkItDown()
+    return _markitdown
+
+
+def read_text(file_path):
+    """
+    读取文本文件。优先按 UTF-8 解码，失败时用 charset_normalizer 检测编码。
+    """
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        from charset_normalizer import from_bytes
+        best = from_bytes(data).best()
+        return str(best) if best is not None else data.decode('utf-8', errors='replace')
+
+
+def convert_markdown(file_path):
+    """
+    Markdown 文件直接读取。
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def convert_csv(file_path):
+    """
+    将 CSV 逐行转换为 Markdown 表格，第一行作为表头。
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+            return csv_to_markdown(file)
+    except UnicodeDecodeError:
+        return csv_to_markdown(io.StringIO(read_text(file_path), newline=''))
+
+
+def csv_to_markdown(file):
+    """
+    将 CSV 行转换为 Markdown 表格行，列数不足的行用空单元格补齐。
+    """
+    lines = []
+    width = 0
+    for row in csv.reader(file):
+        cells = [cell.replace('|', '\\|').replace('\r', ' ').replace('\n', ' ').strip() for cell in row]
+        if not lines:
+            width = max(1, len(cells))
+            lines.append('| ' + ' | '.join(cells + [''] * (width - len(cells))) + ' |')
+            lines.append('|' + ' --- |' * width)
+        else:
+            lines.append('| ' + ' | '.join(cells + [''] * (width - len(cells))) + ' |')
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def convert_json(file_path):
+    """
+    JSON 格式化后放入代码块，无法解析时保留原文。
+    """
+    text = read_text(file_path)
+    try:
+        text = json.dumps(json.loads(text), ensure_ascii=False, indent=2)
+    except ValueError:
+        pass
+    return f"```json\n{text}\n```\n"
+
+
+def convert_xml(file_path):
+    """
+    使用 iterparse 逐个元素提取 XML 中的文本，每段文本一行，无法解析时返回原文。
+    """
+    lines = []
+    try:
+        for _, element in iterparse(file_path, events=('end',)):
+            # 元素结束时子元素的 tail 才完整，因此在父元素结束时提取
+            texts = [element.text] + [child.tail for child in element]
+            lines.extend(text.strip() for text in texts if text and text.strip())
+            # 已处理的子元素不再需要，释放内存
+            del element[:]
+    except ParseError:
+        return read_text(file_path)
+    return '\n\n'.join(lines) + '\n' if lines else ''
+
+
+class HtmlTextExtractor(HTMLParser):
+    """
+    从 HTML 中提取正文，跳过 head/script/style，标题和列表转为 Markdown，块级元素之间空行。
+    """
+    SKIP_TAGS = {'head', 'script', 'style', 'noscript', 'template'}
+    HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    BLOCK_TAGS = {'p', 'div', 'section', 'article', 'header', 'footer', 'nav', 'aside', 'main',
+                  'table', 'tr', 'ul', 'ol', 'blockquote', 'pre', 'hr', 'form', 'dl', 'dt', 'dd'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif self.skip_depth:
+            return
+        elif tag in self.HEADING_TAGS:
+            self.parts.append('\n\n' + '#' * int(tag[1]) + ' ')
+        elif tag == 'li':
+            self.parts.append('\n- ')
+        elif tag == 'br':
+            self.parts.append('\n')
+        elif tag in ('td', 'th'):
+            self.parts.append(' ')
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif not self.skip_depth and (tag in self.HEADING_TAGS or tag in self.BLOCK_TAGS):
+            self.parts.append('\n\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(re.sub(r'\s+', ' ', data))
+
+    def get_text(self):
+        text = ''.join(self.parts)
+        text = re.sub(r'[ \t]*\n[ \t]*', '\n', text)
+        return re.sub(r'\n{3,}', '\n\n', text).strip() + '\n'
+
+
+def convert_html(file_path, chunk_size=64 * 1024):
+    """
+    使用 HTMLParser 分块读取 HTML 并提取正文。
+    """
+    extractor = HtmlTextExtractor()
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+        while chunk := file.read(chunk_size):
+            extractor.feed(chunk)
+    extractor.close()
+    return extractor.get_text()
+
+
+def convert_with_markitdown(file_path):
+    """
+    Office 文件使用 MarkItDown 转换。
+    """
+    markitdown = get_markitdown()
+    from markitdown import FileConversionException, UnsupportedFormatException
+    try:
+        return markitdown.convert(file_path).text_content
+    # MarkItDown 的异常继承自 BaseException，转换为 ValueError 交给 convert_file 处理
+    except (FileConversionException, UnsupportedFormatException) as e:
+        raise ValueError(str(e)) from e
+
+
+# 扩展名与转换函数的对应关系
+CONVERTERS = {
+    '.md': convert_markdown,
+    '.csv': convert_csv,
+    '.json': convert_json,
+    '.xml': convert_xml,
+    '.html': convert_html,
+    '.docx': convert_with_markitdown,
+    '.pptx': convert_with_markitdown,
+    '.xlsx': convert_with_markitdown,
+}
+
+
+def prepare_converter(extension):
+    """
+    提前导入扩展名对应的转换函数用到的模块。
+    markitdown 及其依赖导入需要数秒，在计时和超时之外导入，不计入第一个 Office 文件的解析时间。
+    """
+    extension = extension.lower()
+    if CONVERTERS.get(extension) is convert_with_markitdown:
+        get_markitdown()
+        if extension == '.xlsx':
+            # markitdown 读取 xlsx 时才导入 openpyxl
+            import openpyxl
+
+
+def convert_file(file_path, extension):
+    """
+    按扩展名选择转换函数，将文件转换为 Markdown 文本，失败时返回 None。
+    MemoryError 不在此处理，由调用方记录为超出内存上限。
+    """
+    converter = CONVERTERS.get(extension.lower())
+    if converter is None:
+        raise ValueError(f"Unsupported file extension: {extension}")
+    try:
+        return converter(file_path)
+    except MemoryError:
+        raise
+    except Exception as e:
+        logging.error(f"Error parsing file {file_path}: {e}")
+        return None
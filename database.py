@@ -0,0 +1,309 @@
+import os
+import zlib
+import codecs
+import hashlib
+import logging
+import sqlite3
+
+
+# 数据库结构版本，保存在 PRAGMA user_version 中
+SCHEMA_VERSION = 7
+
+
+def connect(db_path, check_same_thread=True):
+    """
+    打开数据库连接。
+    使用 WAL 日志模式，searcher 读取时不会阻塞 indexer 写入；
+    写锁被占用时等待而不是立即报错。
+    check_same_thread 为 False 时连接可以在多个线程间共享，调用方需自行加锁。
+    """
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def create_database(db_path):
+    """
+    按最新结构创建数据库和表。
+    """
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE indexed (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_path TEXT,
+                file_name TEXT,
+                extension TEXT,
+                file_type TEXT,
+                creation_time TEXT,
+                modification_time TEXT,
+                file_size INTEGER,
+                is_hidden INTEGER,
+                status TEXT,
+                mtime_ns INTEGER,
+                content_hash TEXT,
+                body_hash TEXT,
+                parse_seconds REAL
+            )
+        ''')
+        cursor.execute("CREATE UNIQUE INDEX idx_indexed_file_path ON indexed (file_path)")
+        cursor.execute("CREATE INDEX idx_indexed_body_hash ON indexed (body_hash)")
+        create_blobs_table(cursor)
+        create_meta_table(cursor)
+        create_quarantine_table(cursor)
+        create_unindexed_table(cursor)
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+
+def create_blobs_table(conn):
+    """
+    解析后的文档内容单独存放，按内容哈希去重，zlib 压缩。
+    length 为解压后的字符数，不需要解压就能判断文档大小。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            body_hash TEXT PRIMARY KEY,
+            body BLOB,
+            length INTEGER
+        ) WITHOUT ROWID
+    ''')
+
+
+def create_meta_table(conn):
+    """
+    保存索引状态的键值表，如最近一次完成全量扫描的时间 last_full_scan。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID
+    ''')
+
+
+def create_quarantine_table(conn):
+    """
+    解析失败（超时、超出内存上限、解析进程崩溃等）的文件及失败时的指纹 (file_size, mtime_ns)，
+    指纹不变时不再解析，文件修改后重新尝试。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS quarantine (
+            file_path TEXT PRIMARY KEY,
+            file_size INTEGER,
+            mtime_ns INTEGER,
+            reason TEXT,
+            parse_seconds REAL,
+            attempts INTEGER,
+            quarantined_at REAL
+        ) WITHOUT ROWID
+    ''')
+
+
+def create_unindexed_table(conn):
+    """
+    磁盘上存在但不在 indexed 表中的文件（不支持解析的扩展名、解析失败的文件），
+    与 indexed 一起供目录列表使用，列出的文件与磁盘一致。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS unindexed (
+            file_path TEXT PRIMARY KEY,
+            file_name TEXT,
+            file_size INTEGER,
+            mtime_ns INTEGER
+        ) WITHOUT ROWID
+    ''')
+
+
+def get_meta(conn, key, default=None):
+    """
+    读取 meta 表中的值，不存在时返回 default。
+    """
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(conn, key, value):
+    """
+    写入 meta 表，由调用方提交。
+    """
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def path_prefix_range(dir_path):
+    """
+    目录下所有文件路径的范围，用于 file_path >= ? AND file_path < ? 查询，可以使用 file_path 上的索引。
+    """
+    prefix = dir_path.rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+def compress_body(content):
+    """
+    压缩文档内容，返回 (body_hash, 压缩后的内容, 字符数)。
+    """
+    data = content.encode('utf-8')
+    body_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+    return body_hash, zlib.compress(data, 6), len(content)
+
+
+def decompress_body(body):
+    """
+    解压文档内容。
+    """
+    return zlib.decompress(body).decode('utf-8')
+
+
+def iter_body(body, chunk_size=64 * 1024):
+    """
+    增量解压文档内容，逐块返回文本，不需要一次解压出整个文档。
+    """
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for start in range(0, len(body), chunk_size):
+        yield decoder.decode(decompressor.decompress(body[start:start + chunk_size]))
+    yield decoder.decode(decompressor.flush(), final=True)
+
+
+def store_bodies(conn, bodies):
+    """
+    写入 compress_body 的结果，相同内容只保存一份。
+    """
+    conn.executemany("INSERT OR IGNORE INTO blobs (body_hash, body, length) VALUES (?, ?, ?)", bodies)
+
+
+def load_body(conn, body_hash):
+    """
+    读取并解压文档内容，不存在时返回 None。
+    """
+    row = conn.execute("SELECT body FROM blobs WHERE body_hash = ?", (body_hash,)).fetchone()
+    return decompress_body(row[0]) if row else None
+
+
+def collect_garbage(conn):
+    """
+    删除已没有文件引用的文档内容，返回删除的数量。
+    """
+    cursor = conn.execute(
+        "DELETE FROM blobs WHERE NOT EXISTS (SELECT 1 FROM indexed WHERE indexed.body_hash = blobs.body_hash)"
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def add_missing_columns(conn):
+    """
+    版本 1：补充文件指纹相关的列。
+    """
+    new_columns = {
+        'chkchng': [('mtime_ns', 'INTEGER')],
+        'indexed': [('mtime_ns', 'INTEGER'), ('content_hash', 'TEXT')],
+    }
+    for table, columns in new_columns.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                logging.info(f"Added column {column} to table {table}")
+
+
+def add_path_indexes(conn):
+    """
+    版本 2：file_path 上建立索引，indexed 表中 file_path 唯一。
+    旧数据库中可能有重复的路径，只保留最新的一条。
+    """
+    cursor = conn.execute("DELETE FROM indexed WHERE id NOT IN (SELECT MAX(id) FROM indexed GROUP BY file_path)")
+    if cursor.rowcount:
+        logging.info(f"Removed {cursor.rowcount} duplicate rows from table indexed")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_indexed_file_path ON indexed (file_path)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chkchng_file_path ON chkchng (file_path)")
+
+
+def drop_chkchng(conn):
+    """
+    版本 3：扫描结果直接在内存中与 indexed 表对比，不再需要 chkchng 表。
+    """
+    conn.execute("DROP TABLE IF EXISTS chkchng")
+
+
+def move_bodies_to_blobs(conn, chunk_size=500):
+    """
+    版本 4：indexed.file_content 中的内容压缩后移到 blobs 表，indexed 只保留 body_hash。
+    返回 True 表示升级后需要 VACUUM 回收空间。
+    """
+    create_blobs_table(conn)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(indexed)")}
+    if 'body_hash' not in columns:
+        conn.execute("ALTER TABLE indexed ADD COLUMN body_hash TEXT")
+    if 'file_content' not in columns:
+        return False
+    ids = [row[0] for row in conn.execute("SELECT id FROM indexed WHERE file_content IS NOT NULL")]
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT id, file_content FROM indexed WHERE id IN ({placeholders})", chunk).fetchall()
+        bodies = [(row_id, compress_body(content)) for row_id, content in rows]
+        store_bodies(conn, [body for _, body in bodies])
+        conn.executemany("UPDATE indexed SET body_hash = ? WHERE id = ?", [(body[0], row_id) for row_id, body in bodies])
+    conn.execute("ALTER TABLE indexed DROP COLUMN file_content")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_indexed_body_hash ON indexed (body_hash)")
+    logging.info(f"Moved {len(ids)} document bodies to table blobs")
+    return True
+
+
+def add_meta_table(conn):
+    """
+    版本 5：增加 meta 表。旧数据库没有全量扫描的时间，下一次全量扫描完成前目录列表从磁盘读取。
+    """
+    create_meta_table(conn)
+
+
+def add_quarantine_table(conn):
+    """
+    版本 6：增加 quarantine 表，indexed 表记录每个文件的解析耗时。
+    """
+    create_quarantine_table(conn)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(indexed)")}
+    if 'parse_seconds' not in columns:
+        conn.execute("ALTER TABLE indexed ADD COLUMN parse_seconds REAL")
+
+
+def add_unindexed_table(conn):
+    """
+    版本 7：增加 unindexed 表。下一次全量扫描填充该表之前，目录列表从磁盘读取。
+    """
+    create_unindexed_table(conn)
+    conn.execute("DELETE FROM meta WHERE key = 'last_full_scan'")
+
+
+# 按版本顺序执行的升级步骤
+MIGRATIONS = [
+    (1, add_missing_columns),
+    (2, add_path_indexes),
+    (3, drop_chkchng),
+    (4, move_bodies_to_blobs),
+    (5, add_meta_table),
+    (6, add_quarantine_table),
+    (7, add_unindexed_table),
+]
+
+
+def migrate_database(db_path):
+    """
+    将旧版本数据库升级到 SCHEMA_VERSION，并切换到 WAL 日志模式。
+    """
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        vacuum = False
+        for target_version, migration in MIGRATIONS:
+            if version < target_version:
+                vacuum = migration(conn) or vacuum
+                conn.execute(f"PRAGMA user_version = {target_version}")
+                conn.commit()
+                logging.info(f"Migrated database to version {target_version}")
+        if vacuum:
+            conn.execute("VACUUM")
+            logging.info("Vacuumed database")
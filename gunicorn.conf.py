@@ -0,0 +1,22 @@
+# gunicorn 配置，supervisord 中以 gunicorn -c gunicorn.conf.py searcher:app 启动
+# preload_app 时 searcher 在 master 进程中导入，先打 gevent 补丁，导入时创建的锁才是 gevent 版本
+from gevent import monkey
+monkey.patch_all()
+
+import time
+
+bind = "0.0.0.0:8000"
+workers = 2
+worker_class = "gevent"
+# 在 master 中导入 searcher、打开索引、加载 jieba 词典后再 fork 出 worker，
+# worker 以写时复制的方式共享这些内存，启动时不再重复加载
+preload_app = True
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+# 输出 worker 从 fork 到可以处理请求的耗时
+def post_worker_init(worker):
+    worker.log.info(f"Worker {worker.pid} ready in {time.perf_counter() - worker.forked_at:.3f}s")
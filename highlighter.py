@@ -0,0 +1,203 @@
+import re
+import html
+from functools import lru_cache
+from tokenizer import QUERY_SYNTAX, segment_query
+
+
+# 高亮使用的标签
+HIGHLIGHT_OPEN = '<span style="background-color: yellow;">'
+HIGHLIGHT_CLOSE = "</span>"
+
+# 将 HTML 切分为文本和标签（含注释），切分结果中奇数位置是标签
+TAG_PATTERN = re.compile(r"(<!--.*?-->|<[^>]*>)", re.DOTALL)
+TAG_NAME_PATTERN = re.compile(r"<\s*(/?)\s*([a-zA-Z][a-zA-Z0-9]*)")
+# 这些标签内的文本不做高亮
+SKIP_TAGS = {"script", "style", "code"}
+# 查询语法中不需要高亮的运算符
+QUERY_OPERATORS = {"AND", "OR", "NOT", "ANDNOT", "ANDMAYBE"}
+# 与索引的分析器一致，单个字符只保留中文
+CJK_CHAR = re.compile(r"[\u4E00-\u9FD5]")
+
+
+@lru_cache(maxsize=1024)
+def query_words(query_str):
+    """
+    从查询中取出需要高亮的词：查询本身和 jieba 精确模式切出的词，按长度从长到短排列。
+    与索引一样去掉单个非中文字符，避免高亮正文中的每个字母。
+    """
+    words = {query_str.strip()}
+    text = QUERY_SYNTAX.sub(" ", query_str) if QUERY_SYNTAX.search(query_str) else query_str
+    for word, _ in segment_query(text):
+        if word not in QUERY_OPERATORS and re.search(r"\w", word):
+            words.add(word)
+    words = (word for word in words if len(word) > 1 or CJK_CHAR.match(word))
+    return tuple(sorted(words, key=len, reverse=True))
+
+
+@lru_cache(maxsize=1024)
+def build_pattern(query_str, escaped=True):
+    """
+    构造匹配查询词的正则表达式，不区分大小写，没有可高亮的词时返回 None。
+    escaped 为 True 时用于匹配 HTML 文本，查询词按 HTML 转义，并且整体匹配字符实体，避免把实体拆开。
+    """
+    words = query_words(query_str)
+    if not words:
+        return None
+    if escaped:
+        words = [html.escape(word, quote=False) for word in words]
+        return re.compile(r"&#?\w+;|(" + "|".join(map(re.escape, words)) + ")", re.IGNORECASE)
+    return re.compile("(" + "|".join(map(re.escape, words)) + ")", re.IGNORECASE)
+
+
+def highlight_match(match):
+    if match.group(1) is None:
+        return match.group(0)
+    return HIGHLIGHT_OPEN + match.group(0) + HIGHLIGHT_CLOSE
+
+
+def highlight_html(rendered_html, pattern):
+    """
+    单次遍历渲染后的 HTML，为文本中的查询词加上高亮，跳过标签本身和 script/style/code 中的文本。
+    """
+    parts = TAG_PATTERN.split(rendered_html)
+    skip_depth = 0
+    for i, part in enumerate(parts):
+        if i % 2:
+            match = TAG_NAME_PATTERN.match(part)
+            if match and match.group(2).lower() in SKIP_TAGS and not part.endswith("/>"):
+                skip_depth = max(0, skip_depth + (-1 if match.group(1) else 1))
+        elif part and not skip_depth:
+            parts[i] = pattern.sub(highlight_match, part)
+    return "".join(parts)
+
+
+def find_fragments(chunks, pattern, context=200, limit=50, overlap=0, head_size=2000):
+    """
+    在逐块解压的文本中查找匹配位置，匹配前后各扩展 context 个字符并合并重叠的范围，最多 limit 个片段。
+    返回 (片段列表, 开头, 开头后是否还有内容)，片段为 (文本, 是否从文档开头开始, 是否到文档结尾)，
+    开头为文档前 head_size 个字符，没有匹配时显示。
+    overlap 为最长查询词的长度，块末尾不足 overlap 个字符时等下一块再查找，跨块的匹配不会丢失。
+    只在内存中保留未结束的片段和末尾的一段文本，找到 limit 个片段后不再继续解压。
+    """
+    fragments = []
+    head = ""
+    # buffer 为文本中从 offset 开始的部分，pos 之前（buffer 中的位置）已经查找过
+    buffer = ""
+    offset = 0
+    pos = 0
+    # 尚未结束的片段 [start, end]，为文本中的位置，后面的匹配可能与它合并
+    current = None
+    final = False
+    chunks = iter(chunks)
+
+    def close(fragment_range):
+        fragment_start, fragment_end = fragment_range
+        text = buffer[fragment_start - offset:fragment_end - offset]
+        at_end = final and fragment_end >= offset + len(buffer)
+        fragments.append((text, fragment_start == 0, at_end))
+
+    while not final and len(fragments) < limit:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            buffer += chunk
+            if len(head) < head_size:
+                head += chunk[:head_size - len(head)]
+        if pattern is None:
+            if len(head) >= head_size:
+                break
+            continue
+        searchable = len(buffer) if final else max(pos, len(buffer) - overlap)
+        for match in pattern.finditer(buffer, pos):
+            if match.start() >= searchable:
+                break
+            pos = match.end()
+            match_start = max(0, offset + match.start() - context)
+            match_end = offset + match.end() + context
+            if current and match_start <= current[1]:
+                current[1] = match_end
+                continue
+            if current:
+                close(current)
+                if len(fragments) >= limit:
+                    current = None
+                    break
+            current = [match_start, match_end]
+        if len(fragments) >= limit:
+            break
+        # searchable 之前的匹配都已找到
+        pos = max(pos, searchable)
+        # 之后的匹配都从 pos 开始，片段结束位置之后 context 个字符都已查找过时不会再合并
+        if current and (final or offset + pos > current[1] + context):
+            close(current)
+            current = None
+        # 丢掉之后不会再用到的文本
+        keep_from = offset + pos - context
+        if current:
+            keep_from = min(keep_from, current[0])
+        if keep_from > offset:
+            buffer = buffer[keep_from - offset:]
+            pos -= keep_from - offset
+            offset = keep_from
+    if current and len(fragments) < limit:
+        close(current)
+    more = not final or offset + len(buffer) > len(head)
+    return fragments, head, more
+
+
+def render_fragments(chunks, query_str, full_url, context=200, limit=50):
+    """
+    只渲染大文档中匹配查询的片段，并提供查看全文的链接。没有匹配时显示文档开头。
+    chunks 为逐块解压的文本，见 database.iter_body，不需要把整个文档解压到内存中。
+    """
+    overlap = max((len(word) for word in query_words(query_str)), default=0)
+    fragments, head, more = find_fragments(
+        chunks, build_pattern(query_str, escaped=False), context, limit, overlap, head_size=context * 10
+    )
+    if fragments:
+        summary = f"文档较大，只显示匹配的 {len(fragments)} 处片段。"
+    else:
+        fragments = [(head, True, not more)]
+        summary = "文档较大，没有找到匹配的内容，只显示开头部分。"
+    pattern = build_pattern(query_str)
+    parts = [f'<p class="fragment-summary">{summary}<a href="{html.escape(full_url)}">显示全文</a></p>']
+    for text, at_start, at_end in fragments:
+        fragment = html.escape(text, quote=False)
+        if pattern:
+            fragment = highlight_html(fragment, pattern)
+        prefix = "" if at_start else "…"
+        suffix = "" if at_end else "…"
+        parts.append(
+            f'<pre class="fragment">{prefix}{fragment}{suffix}</pre>'
+        )
+    return "\n".join(parts)
+
+
+def make_snippet(chunks, query_str, context=80):
+    """
+    从逐块解压的文本中取出第一个匹配位置前后各 context 个字符作为摘要，找到后不再继续解压。
+    没有匹配时返回开头的内容。
+    """
+    pattern = build_pattern(query_str, escaped=False)
+    # 未匹配时只保留末尾的一段，使跨块的匹配和它前面的上下文不丢失
+    keep = context + max((len(word) for word in query_words(query_str)), default=0)
+    buffer = ""
+    head = ""
+    for chunk in chunks:
+        buffer += chunk
+        if len(head) < context * 2:
+            head += chunk[:context * 2 - len(head)]
+        match = pattern.search(buffer) if pattern else None
+        if match and len(buffer) - match.end() >= context:
+            break
+        if not match and len(buffer) > keep:
+            buffer = buffer[-keep:]
+    else:
+        match = pattern.search(buffer) if pattern else None
+    if match:
+        start = max(0, match.start() - context)
+        snippet = buffer[start:match.end() + context]
+    else:
+        snippet = head
+    return " ".join(snippet.split())
@@ -1,18 +1,31 @@
 import os
 import os.path
-import sqlite3
+import sys
+import json
+import argparse
+import stat
 import configparser
 import queue
 import time
+import itertools
+import collections
+import threading
 import logging
+import signal
+import resource
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 import shutil
-import jieba.analyse
-from jieba.analyse import ChineseAnalyzer
-from whoosh.fields import Schema, TEXT, ID
-from whoosh.index import create_in, open_dir, exists_in
-from markitdown import MarkItDown
-from tokenizer import create_index, open_index, add_document_to_index, delete_document_from_index
+import hashlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import jieba
+from whoosh.index import exists_in
+from converters import CONVERTERS, convert_file, prepare_converter
+from database import connect, create_database, migrate_database, compress_body, decompress_body, store_bodies, collect_garbage, set_meta, path_prefix_range
+from startup import StartupTimer, load_jieba, worker_context
+from metrics import REGISTRY
+from tokenizer import create_index, open_index, add_document_to_index, delete_document_from_index, segment_content, get_writer, segment_count, merge_segments
 
 
 
@@ -29,7 +42,16 @@ def read_config(config_file, script_dir):
         'max_files_per_batch': int(config['Batch']['max_files_per_batch']),
         'queue_size_limit': int(config['Queue']['queue_size_limit']),
         'log_level': config['Logging']['log_level'],
-        'max_index_processes': int(config['Index_processes']['max_index_processes'])
+        'max_index_processes': int(config['Index_processes']['max_index_processes']),
+        # 单个文件的解析限制，0 表示不限制
+        'parse_timeout': config.getint('Index_processes', 'parse_timeout', fallback=300),
+        'parse_memory_mb': config.getint('Index_processes', 'parse_memory_mb', fallback=2048),
+        # Whoosh 写入和段合并，旧配置文件中没有该段时使用默认值
+        'bulk_threshold': config.getint('Whoosh', 'bulk_threshold', fallback=1000),
+        'writer_procs': config.getint('Whoosh', 'writer_procs', fallback=1),
+        'writer_limitmb': config.getint('Whoosh', 'writer_limitmb', fallback=128),
+        'max_segments': config.getint('Whoosh', 'max_segments', fallback=10),
+        'optimize_interval': config.getint('Whoosh', 'optimize_interval', fallback=86400),
     }
 
 
@@ -47,42 +69,6 @@ def setup_logging(log_file_path, log_level):
 
 
 
-# 创建数据库和表
-def create_database(db_path):
-    # if not os.path.exists(db_path):
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE chkchng (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_path TEXT,
-                file_name TEXT,
-                extension TEXT,
-                file_type TEXT,
-                creation_time TEXT,
-                modification_time TEXT,
-                file_size INTEGER,
-                is_hidden INTEGER,
-                status TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE indexed (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_path TEXT,
-                file_name TEXT,
-                extension TEXT,
-                file_type TEXT,
-                creation_time TEXT,
-                modification_time TEXT,
-                file_size INTEGER,
-                is_hidden INTEGER,
-                status TEXT,
-                file_content TEXT
-            )
-        ''')
-        conn.commit()
-
 # 删除索引目录并重新创建
 def remove_index_dir(index_dir):
     if not os.path.exists(index_dir):
@@ -93,202 +79,942 @@ def remove_index_dir(index_dir):
         os.makedirs(index_dir)
         logging.debug("Created index directory")
 
-# 扫描文件夹
-def scan_folder(folder_path, conn):
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_path = file_path.encode('utf-8', errors='ignore').decode('utf-8')
-            file_extension = os.path.splitext(file_path)[1].lower()
-            
-            if file_extension in ['.docx', '.pptx', '.xlsx', '.csv', '.json', '.xml','.html','.md']:
-                file_attributes = get_file_attributes(file_path)
-                if file_attributes:
-                    insert_file_attributes_to_db(conn, [file_attributes])
-            else:
-                logging.info(f"Skipped file with unsupported extension: {file_path}")
+# 支持解析的文件扩展名
+SUPPORTED_EXTENSIONS = list(CONVERTERS)
+
+# 索引各阶段的指标，每次索引任务开始时清空，结束后写入运行摘要，见 index_run
+SCAN_SECONDS = REGISTRY.histogram("index_scan_seconds", "扫描目录并与已索引记录对比所用的时间")
+PARSE_SECONDS = REGISTRY.histogram("index_parse_seconds", "转换单个文件所用的时间", ("extension",))
+SEGMENT_SECONDS = REGISTRY.histogram("index_segment_seconds", "对单个文件分词所用的时间")
+WHOOSH_COMMIT_SECONDS = REGISTRY.histogram("index_whoosh_commit_seconds", "每批提交 Whoosh 索引所用的时间")
+SQLITE_COMMIT_SECONDS = REGISTRY.histogram("index_sqlite_commit_seconds", "每批提交 SQLite 所用的时间")
+FILES_TOTAL = REGISTRY.counter("index_files_total", "按结果统计的文件数", ("status",))
+PARSE_FAILURES = REGISTRY.counter("index_parse_failures_total", "按原因统计解析失败的文件数", ("reason",))
+
+# 扫描单个目录（不递归），返回 (文件属性列表, 子目录列表)
+# 使用 os.scandir，每个文件只 stat 一次。不支持解析的文件也会返回，用于目录列表，见 is_supported
+def scan_directory(dir_path):
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        # 与 os.walk 一致，不进入符号链接目录
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    file_path = entry.path.encode('utf-8', errors='ignore').decode('utf-8')
+                    file_extension = os.path.splitext(file_path)[1].lower()
+                    if file_extension not in SUPPORTED_EXTENSIONS:
+                        logging.debug(f"Listed but not indexed, unsupported extension: {file_path}")
+                    file_attributes = get_file_attributes(file_path, entry.stat())
+                    if file_attributes:
+                        files.append(file_attributes)
+                except OSError as e:
+                    logging.error(f"Error getting file attributes for {entry.path}: {e}")
+    except OSError as e:
+        logging.error(f"Error scanning directory {dir_path}: {e}")
+    return files, subdirs
+
+# 并行扫描文件夹
+# 由 max_workers 个线程同时扫描目录，扫描结果按 batch_size 分批放入长度为 queue_size 的队列，
+# 调用方逐批取出后与已索引的记录对比
+def scan_folders(folders, max_workers, batch_size, queue_size):
+    batches = queue.Queue(maxsize=queue_size)
+
+    def dispatch():
+        pending = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                futures = {executor.submit(scan_directory, folder) for folder in folders}
+                while futures:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        files, subdirs = future.result()
+                        futures.update(executor.submit(scan_directory, subdir) for subdir in subdirs)
+                        pending.extend(files)
+                        while len(pending) >= batch_size:
+                            batches.put(pending[:batch_size])
+                            pending = pending[batch_size:]
+            if pending:
+                batches.put(pending)
+        except Exception as e:
+            logging.error(f"Error scanning folders: {e}")
+        finally:
+            batches.put(None)
+
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        yield batch
+    dispatcher.join()
 
 
 # 获取文件属性
-def get_file_attributes(file_path):
+# file_stats 为已获取的 stat 结果时不再重复 stat
+def get_file_attributes(file_path, file_stats=None):
     try:
-        file_stats = os.stat(file_path)
+        if file_stats is None:
+            file_stats = os.stat(file_path)
         return {
             'file_path': file_path,
             'file_name': os.path.basename(file_path),
             'extension': os.path.splitext(file_path)[1],
-            'file_type': 'file' if os.path.isfile(file_path) else 'directory',
+            'file_type': 'file' if stat.S_ISREG(file_stats.st_mode) else 'directory',
             'creation_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(file_stats.st_ctime)),
             'modification_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(file_stats.st_mtime)),
             'file_size': file_stats.st_size,
             'is_hidden': int(os.path.basename(file_path).startswith('.')),
-            'status': 'waiting_to_index'
+            'status': 'waiting_to_index',
+            'mtime_ns': file_stats.st_mtime_ns
         }
     except Exception as e:
         logging.error(f"Error getting file attributes for {file_path}: {e}")
         return None
 
 
-# 写入数据库
-def insert_file_attributes_to_db(conn, attributes):
-    cursor = conn.cursor()
-    for attr in attributes:
-        try:
-            cursor.execute('''
-                INSERT INTO chkchng (file_path, file_name, extension, file_type, creation_time, modification_time, file_size, is_hidden, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (attr['file_path'], attr['file_name'], attr['extension'], attr['file_type'], attr['creation_time'], attr['modification_time'], attr['file_size'], attr['is_hidden'], attr['status']))
-        except Exception as e:
-            logging.error(f"Error inserting file attributes into database: {e}")
-    conn.commit()
-
-
-# 解析Markdown文件
-def parse_md(file_path):
+# 解析文件，按扩展名交给 converters 中对应的转换函数
+def parse_file(file_path, extension):
+    return convert_file(file_path, extension)
+
+# 解析进程中单个文件的解析时间上限（秒），由 init_index_worker 设置
+worker_limits = {'timeout': 0}
+
+# 单个文件解析超时
+# 继承 BaseException，不会被转换函数和 markitdown 中的 except Exception 捕获
+class ParseTimeout(BaseException):
+    pass
+
+def raise_parse_timeout(signum, frame):
+    raise ParseTimeout()
+
+# 限制代码块的运行时间，超过 timeout 秒抛出 ParseTimeout，只在主线程中生效
+# 转换卡在不返回 Python 的 C 代码中时收不到超时异常，由 CPU 时间上限兜底：
+# 用掉 timeout 两倍的 CPU 时间后进程被 SIGXCPU 终止，由 ParsePool 处理
+@contextmanager
+def parse_time_limit(timeout):
+    if timeout <= 0 or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_limit = int(usage.ru_utime + usage.ru_stime + timeout * 2) + 1
+    if hard != resource.RLIM_INFINITY:
+        cpu_limit = min(cpu_limit, hard)
+    previous = signal.signal(signal.SIGALRM, raise_parse_timeout)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, hard))
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+# 索引进程初始化，提前加载 jieba 词典
+# 非 fork 方式启动的进程不会继承日志配置，需要传入日志文件重新设置
+# parse_timeout 和 parse_memory_mb 为单个文件的解析时间上限和进程的内存上限，只在解析进程中设置
+def init_index_worker(log_file_path=None, log_level=None, parse_timeout=0, parse_memory_mb=0):
+    if log_file_path:
+        setup_logging(log_file_path, log_level)
+    # forkserver 已预加载词典时不再加载
+    load_jieba()
+    worker_limits['timeout'] = parse_timeout
+    if parse_memory_mb > 0:
+        # 限制的是地址空间而不是 RSS（Linux 不支持限制 RSS），超出时分配内存抛出 MemoryError
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = parse_memory_mb * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+# 计算文件内容的哈希
+def hash_file(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# 解析并分词单个文件，在索引进程中执行
+# job 为 (row, existed, old_hash)，row 为 (file_path, file_name, extension, ...)，
+# existed 表示 indexed 表中已有该文件，old_hash 为已索引内容的哈希。
+# 返回 (job, status, content_hash, body, segmented_content, timings, reason)，status 为
+# indexed（已解析）、unchanged（内容哈希未变，无需重新解析）或 failed（解析失败），
+# body 为压缩后的解析内容 (body_hash, 压缩内容, 字符数)，
+# timings 为 (转换文件所用的时间, 分词所用的时间)，未执行的步骤为 0，
+# reason 为解析失败的原因：timeout（超时）、memory（超出内存上限）、unparsable（转换失败）、
+# empty（没有内容）、error（其他异常）、crashed（解析进程退出，见 ParsePool），
+# 有原因的失败文件会被隔离，见 write_batch；读取文件出错时为 None，下次运行重试
+def parse_and_segment(job):
+    row, existed, old_hash = job
+    file_path, file_name, extension = row[0], row[1], row[2]
+    try:
+        content_hash = hash_file(file_path)
+    except OSError as e:
+        logging.error(f"Error processing file {file_path}: {e}")
+        return job, 'failed', None, None, None, (0, 0), None
+    if old_hash and content_hash == old_hash:
+        return job, 'unchanged', content_hash, None, None, (0, 0), None
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-            return content
+        prepare_converter(extension)
     except Exception as e:
-        logging.error(f"Error parsing Markdown file {file_path}: {e}")
-        return None
+        # 导入失败时由下面的转换记录失败原因
+        logging.error(f"Error loading converter for {file_path}: {e}")
 
-# 解析非 markdown 文件
-def parse_to_md(file_path):
+    started = time.perf_counter()
     try:
-        md = MarkItDown()
-        result = md.convert(file_path)
-        content = result.text_content
-        return content
+        with parse_time_limit(worker_limits['timeout']):
+            content = parse_file(file_path, extension)
+            parse_seconds = time.perf_counter() - started
+            if not content:
+                reason = 'empty' if content == '' else 'unparsable'
+                return job, 'failed', content_hash, None, None, (parse_seconds, 0), reason
+            start = time.perf_counter()
+            segmented_content = segment_content(file_name, content)
+            segment_seconds = time.perf_counter() - start
+    except ParseTimeout:
+        elapsed = time.perf_counter() - started
+        logging.error(f"Timed out processing file {file_path} after {elapsed:.1f}s")
+        return job, 'failed', content_hash, None, None, (elapsed, 0), 'timeout'
+    except MemoryError:
+        elapsed = time.perf_counter() - started
+        logging.error(f"Out of memory processing file {file_path} after {elapsed:.1f}s")
+        return job, 'failed', content_hash, None, None, (elapsed, 0), 'memory'
     except Exception as e:
-        logging.error(f"Error parsing file {file_path}: {e}")
-        return None
-
-# 解析文件
-def parse_file(file_path, extension):
-    if extension == '.md':
-        return parse_md(file_path)
-    elif extension in ['.docx', '.pptx', '.xlsx', '.csv', '.json', '.xml','.html','.md']:
-        return parse_to_md(file_path)
-    else:
-        raise ValueError(f"Unsupported file extension: {extension}")
-
-# 主函数
-def main():
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(script_dir, "data/config","config.ini")
-    log_file_path = os.path.join(script_dir, "data/logs","logs.log")
-    db_file_path = os.path.join(script_dir, "data", "index.db")
-    index_dir = os.path.join(script_dir, "data", "index_dir")
-
-    # 如果日志文件不存在则创建
-    if not os.path.exists(log_file_path):
-        with open(log_file_path, 'a'):
-            os.utime(log_file_path, None)
+        logging.error(f"Error processing file {file_path}: {e}")
+        return job, 'failed', content_hash, None, None, (time.perf_counter() - started, 0), 'error'
+    return job, 'indexed', content_hash, compress_body(content), segmented_content, (parse_seconds, segment_seconds), None
+
+# 解析进程池
+# 解析进程被 SIGXCPU、OOM killer 终止或崩溃后，整个进程池无法继续使用：此时重新创建进程池，
+# 未完成的文件逐个放到单独的进程中重新解析，再次导致进程退出的文件记为 crashed
+class ParsePool:
+    def __init__(self, max_workers, initargs):
+        self.max_workers = max_workers
+        self.initargs = initargs
+        self.executor = self.create_executor(max_workers)
+
+    def create_executor(self, max_workers):
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=worker_context(),
+            initializer=init_index_worker,
+            initargs=self.initargs,
+        )
+
+    # 与 executor.map 相同，但同时提交的任务不超过 window 个，避免解析结果堆积在内存中
+    def map(self, jobs, window):
+        jobs = iter(jobs)
+        # [job, future]，提交失败时 future 为 None
+        pending = collections.deque()
+        while True:
+            broken = False
+            try:
+                while len(pending) < window:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    entry = [job, None]
+                    pending.append(entry)
+                    entry[1] = self.executor.submit(parse_and_segment, job)
+                if not pending:
+                    return
+                result = pending[0][1].result()
+            except BrokenProcessPool:
+                broken = True
+            if broken:
+                yield from self.recover(list(pending))
+                pending.clear()
+                continue
+            pending.popleft()
+            yield result
+
+    # 重新创建进程池，已完成的结果直接返回，其余文件逐个在单独的进程中解析
+    def recover(self, pending):
+        logging.error(f"A parse worker exited unexpectedly, retrying {len(pending)} files one by one")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.create_executor(self.max_workers)
+        for job, future in pending:
+            if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                yield future.result()
+            else:
+                yield self.parse_isolated(job)
+
+    def parse_isolated(self, job):
+        with self.create_executor(1) as executor:
+            try:
+                return executor.submit(parse_and_segment, job).result()
+            except BrokenProcessPool:
+                logging.error(f"Parse worker exited while processing file {job[0][0]}")
+                return job, 'failed', None, None, None, (0, 0), 'crashed'
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+# 解析和分词，按提交顺序返回结果
+# 结果交回主进程，由唯一的 Whoosh writer 和 SQLite 连接写入
+# 传入 pool 时在解析进程中执行，否则在当前进程中执行
+def parse_files(jobs, pool=None, window=100):
+    if pool is not None:
+        yield from pool.map(jobs, window)
+        return
+
+    init_index_worker()
+    for job in jobs:
+        yield parse_and_segment(job)
+
+# 文件属性转为待解析的行，字段顺序与 indexed 表一致
+def attributes_to_row(attr):
+    return (attr['file_path'], attr['file_name'], attr['extension'], attr['file_type'],
+            attr['creation_time'], attr['modification_time'], attr['file_size'], attr['is_hidden'],
+            attr['mtime_ns'])
+
+# 读取已索引文件的指纹，返回 {file_path: (file_size, mtime)}
+# 旧版本数据库中没有 mtime_ns 的记录，mtime 为秒级的 modification_time 字符串
+def load_indexed_fingerprints(conn):
+    cursor = conn.execute("SELECT file_path, file_size, COALESCE(mtime_ns, modification_time) FROM indexed")
+    return {file_path: (file_size, mtime) for file_path, file_size, mtime in cursor}
+
+# 读取被隔离文件的指纹，返回 {file_path: (file_size, mtime_ns)}
+def load_quarantine(conn):
+    cursor = conn.execute("SELECT file_path, file_size, mtime_ns FROM quarantine")
+    return {file_path: (file_size, mtime_ns) for file_path, file_size, mtime_ns in cursor}
+
+# 文件与被隔离时的指纹相同，不需要再次解析
+def is_quarantined(fingerprint, attr):
+    return fingerprint is not None and tuple(fingerprint) == (attr['file_size'], attr['mtime_ns'])
+
+# 文件扩展名是否支持解析
+def is_supported(attr):
+    return attr['extension'].lower() in SUPPORTED_EXTENSIONS
+
+# 读取没有索引的文件的指纹，返回 {file_path: (file_size, mtime_ns)}
+def load_unindexed(conn):
+    cursor = conn.execute("SELECT file_path, file_size, mtime_ns FROM unindexed")
+    return {file_path: (file_size, mtime_ns) for file_path, file_size, mtime_ns in cursor}
+
+# 记录没有索引的文件，rows 为 (file_path, file_name, file_size, mtime_ns)，由调用方提交
+def store_unindexed(conn, rows):
+    conn.executemany("""
+        INSERT INTO unindexed (file_path, file_name, file_size, mtime_ns) VALUES (?, ?, ?, ?)
+        ON CONFLICT (file_path) DO UPDATE SET
+            file_name = excluded.file_name, file_size = excluded.file_size, mtime_ns = excluded.mtime_ns
+    """, rows)
+
+# 判断文件指纹（大小 + mtime_ns）是否与已索引的记录不同
+def fingerprint_changed(fingerprint, attr):
+    file_size, mtime = fingerprint
+    if file_size != attr['file_size']:
+        return True
+    if isinstance(mtime, str):
+        return mtime != attr['modification_time']
+    return mtime != attr['mtime_ns']
+
+# 打开索引，不存在则创建
+def open_or_create_index(index_dir):
+    if not exists_in(index_dir):
+        return create_index(index_dir)
+    return open_index(index_dir)
+
+# 解析、分词并写入 Whoosh 索引和数据库
+# jobs 的格式见 parse_and_segment。每 max_files_per_batch 个文件同时提交一次 Whoosh 和 SQLite，
+# 内存中最多保留两批解析结果；中途退出时已提交的批次不会丢失，下次运行只处理剩下的文件。
+# 每批提交时不合并段，段的合并由 merge_if_needed 和常驻服务的空闲维护负责
+def index_rows(conn, ix, jobs, config, pool=None):
+    batch_size = max(1, config['max_files_per_batch'])
+    # 文件数较多时视为批量导入，可使用多进程 writer
+    # 多进程 writer 每次创建都要启动子进程，此时每批按 bulk_threshold 个文件提交
+    writer_args = {'limitmb': config['writer_limitmb']}
+    if len(jobs) >= config['bulk_threshold'] and config['writer_procs'] > 1:
+        writer_args.update(procs=config['writer_procs'], multisegment=True)
+        batch_size = max(batch_size, config['bulk_threshold'])
+    results = parse_files(jobs, pool, window=batch_size * 2)
+    total_indexed = 0
+    total_unchanged = 0
+    total_quarantined = 0
+    while True:
+        batch = list(itertools.islice(results, batch_size))
+        if not batch:
+            break
+        for job, status, _, _, _, (parse_seconds, segment_seconds), reason in batch:
+            FILES_TOTAL.inc(status=status)
+            if status != 'unchanged':
+                PARSE_SECONDS.observe(parse_seconds, extension=job[0][2].lower())
+            if status == 'indexed':
+                SEGMENT_SECONDS.observe(segment_seconds)
+            if reason:
+                PARSE_FAILURES.inc(reason=reason)
+        indexed, unchanged, quarantined = write_batch(conn, ix, batch, writer_args)
+        total_indexed += indexed
+        total_unchanged += unchanged
+        total_quarantined += quarantined
+    logging.info(f"Indexed {total_indexed} files, {total_unchanged} files unchanged, {total_quarantined} files quarantined.")
+
+# 将一批解析结果写入 Whoosh 索引和数据库并提交，返回 (索引文件数, 未变化文件数, 隔离文件数)
+# 有失败原因的文件连同指纹记入 quarantine 表，文件修改前不再解析；解析成功的文件移出 quarantine 表
+def write_batch(conn, ix, results, writer_args):
+    data_to_insert = []
+    data_to_update = []
+    data_to_quarantine = []
+    data_to_list = []
+    bodies = []
+    writer = get_writer(ix, **writer_args)
+    searcher = writer.searcher()
+    try:
+        for job, status, content_hash, body, segmented_content, timings, reason in results:
+            row, existed, _ = job
+            file_path = row[0]
+            if status == 'unchanged':
+                # 只是修改时间变化，内容没变，更新元数据即可
+                data_to_update.append((row[4], row[5], row[6], row[8], file_path))
+                logging.info(f"Skipped unchanged file: {file_path}")
+                continue
+
+            # 删除旧的索引，数据库记录在插入时覆盖
+            # 新文件也先删除一次，上次运行在 Whoosh 提交后、SQLite 提交前中断时不会重复索引
+            delete_document_from_index(writer, file_path, searcher)
+            if existed:
+                logging.info(f"Deleted file from index: {file_path}")
+
+            if status == 'indexed':
+                # 构建需要插入的数据
+                data_to_insert.append(row + ('indexed', content_hash, body[0], timings[0]))
+                bodies.append(body)
+                # Whoosh 索引
+                add_document_to_index(writer, file_path, row[1], None, segmented_content)  # 使用row[1]作为文件名
+                logging.info(f"Parsed and indexed file: {file_path}")
+            else:
+                if existed:
+                    conn.execute("DELETE FROM indexed WHERE file_path = ?", (file_path,))
+                # 解析失败的文件仍在磁盘上，目录列表中照常显示
+                data_to_list.append((file_path, row[1], row[6], row[8]))
+                if reason:
+                    data_to_quarantine.append((file_path, row[6], row[8], reason, timings[0], time.time()))
+                    logging.error(f"Failed to parse file, quarantined until it changes ({reason}): {file_path}")
+                else:
+                    logging.error(f"Failed to parse file: {file_path}")
+
+        # 批量更新和插入数据
+        if data_to_update:
+            conn.executemany("UPDATE indexed SET creation_time = ?, modification_time = ?, file_size = ?, mtime_ns = ? WHERE file_path = ?", data_to_update)
+        if data_to_insert:
+            store_bodies(conn, bodies)
+            conn.executemany("""
+                INSERT INTO indexed (file_path, file_name, extension, file_type, creation_time, modification_time, file_size, is_hidden, mtime_ns, status, content_hash, body_hash, parse_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (file_path) DO UPDATE SET
+                    file_name = excluded.file_name, extension = excluded.extension, file_type = excluded.file_type,
+                    creation_time = excluded.creation_time, modification_time = excluded.modification_time,
+                    file_size = excluded.file_size, is_hidden = excluded.is_hidden, mtime_ns = excluded.mtime_ns,
+                    status = excluded.status, content_hash = excluded.content_hash, body_hash = excluded.body_hash,
+                    parse_seconds = excluded.parse_seconds
+            """, data_to_insert)
+            conn.executemany("DELETE FROM quarantine WHERE file_path = ?", [(item[0],) for item in data_to_insert])
+            conn.executemany("DELETE FROM unindexed WHERE file_path = ?", [(item[0],) for item in data_to_insert])
+        if data_to_list:
+            store_unindexed(conn, data_to_list)
+        if data_to_quarantine:
+            conn.executemany("""
+                INSERT INTO quarantine (file_path, file_size, mtime_ns, reason, parse_seconds, attempts, quarantined_at)
+                VALUES (?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (file_path) DO UPDATE SET
+                    file_size = excluded.file_size, mtime_ns = excluded.mtime_ns, reason = excluded.reason,
+                    parse_seconds = excluded.parse_seconds, attempts = quarantine.attempts + 1,
+                    quarantined_at = excluded.quarantined_at
+            """, data_to_quarantine)
+
+        # 先提交 Whoosh 再提交 SQLite，SQLite 中有记录的文件一定已经在索引中
+        searcher.close()
+        with WHOOSH_COMMIT_SECONDS.time():
+            writer.commit(merge=False)
+        with SQLITE_COMMIT_SECONDS.time():
+            conn.commit()
+    except Exception:
+        searcher.close()
+        writer.cancel()
+        conn.rollback()
+        raise
+    return len(data_to_insert), len(data_to_update), len(data_to_quarantine)
+
+# 段数量超过 max_segments 时合并较小的段，合并后约为 max_segments 的一半
+def merge_if_needed(ix, config):
+    if segment_count(ix) > config['max_segments']:
+        before, after = merge_segments(ix, keep=config['max_segments'] // 2)
+        logging.info(f"Merged index segments: {before} -> {after}")
+
+# 从 Whoosh 索引和数据库中删除文件
+def remove_documents(conn, ix, paths):
+    writer = ix.writer()
+    searcher = writer.searcher()
+    try:
+        for remove_index_path in paths:
+            delete_document_from_index(writer, remove_index_path, searcher)
+            logging.info(f"Deleted file from index: {remove_index_path}")
+        conn.executemany("DELETE FROM indexed WHERE file_path = ?", [(path,) for path in paths])
+        FILES_TOTAL.inc(len(paths), status='deleted')
+        searcher.close()
+        writer.commit()
+        conn.commit()
+    except Exception:
+        searcher.close()
+        writer.cancel()
+        conn.rollback()
+        raise
+
+# 删除文件被删除或内容变化后不再被引用的文档内容
+def remove_orphan_bodies(conn):
+    removed = collect_garbage(conn)
+    if removed:
+        logging.info(f"Removed {removed} unreferenced document bodies")
+
+# 全量扫描，在内存中与已索引文件的指纹对比后整理数据库和索引
+# 未变化的文件不写数据库
+def full_index(conn, ix, config, pool=None):
+    cursor = conn.cursor()
+    # 扫描到的文件会从 fingerprints、quarantined 和 unindexed 中移除，剩下的就是已经不存在的文件
+    fingerprints = load_indexed_fingerprints(conn)
+    quarantined = load_quarantine(conn)
+    unindexed = load_unindexed(conn)
+    # 需要写入 unindexed 的新文件或指纹变化的文件
+    unlisted = []
+    skipped = 0
+    # 文件夹配置重叠（如 input 和 input/sub）时同一个文件会被扫描到两次，只处理第一次
+    seen_paths = set()
+    jobs = []
+    backfill = []
+    scan_started = time.perf_counter()
+
+    for batch in scan_folders(config['folders'], config['max_scan_processes'], config['max_files_per_batch'], config['queue_size_limit']):
+        changed = []
+        for attr in batch:
+            file_path = attr['file_path']
+            if file_path in seen_paths:
+                continue
+            seen_paths.add(file_path)
+            if not is_supported(attr):
+                # 不支持解析的文件只记录到 unindexed 供目录列表使用，指纹变化时才写数据库
+                if unindexed.pop(file_path, None) != (attr['file_size'], attr['mtime_ns']):
+                    unlisted.append((file_path, attr['file_name'], attr['file_size'], attr['mtime_ns']))
+                continue
+            fingerprint = fingerprints.pop(file_path, None)
+            if fingerprint is None:
+                # 解析失败的文件已在 unindexed 中，重新解析后由 write_batch 更新
+                listed = unindexed.pop(file_path, None)
+                # 被隔离的文件没有变化时跳过，旧版本隔离的文件不在 unindexed 中，补充记录
+                if is_quarantined(quarantined.pop(file_path, None), attr):
+                    skipped += 1
+                    if listed != (attr['file_size'], attr['mtime_ns']):
+                        unlisted.append((file_path, attr['file_name'], attr['file_size'], attr['mtime_ns']))
+                    continue
+                jobs.append((attributes_to_row(attr), False, None))
+            elif fingerprint_changed(fingerprint, attr):
+                changed.append(attr)
+            elif isinstance(fingerprint[1], str):
+                # 旧版本数据库没有 mtime_ns，修改时间和大小都没变的记录直接补齐
+                backfill.append((attr['mtime_ns'], file_path))
+
+        # 指纹变化的文件会先比较内容哈希，哈希不变则不重新解析
+        for attr in changed:
+            cursor.execute("SELECT content_hash FROM indexed WHERE file_path = ?", (attr['file_path'],))
+            jobs.append((attributes_to_row(attr), True, cursor.fetchone()[0]))
+
+    if backfill:
+        cursor.executemany("UPDATE indexed SET mtime_ns = ? WHERE file_path = ?", backfill)
+        conn.commit()
+    SCAN_SECONDS.observe(time.perf_counter() - scan_started)
+    if skipped:
+        FILES_TOTAL.inc(skipped, status='quarantined')
+        logging.info(f"Skipped {skipped} quarantined files")
 
-    config = read_config(config_path, script_dir)
-    setup_logging(log_file_path, config['log_level'])
+    try:
+        # 删除已经不存在文件的索引和数据库记录
+        delete_paths = list(fingerprints)
+        if delete_paths:
+            remove_documents(conn, ix, delete_paths)
+        logging.info(f"Deleted {len(delete_paths)} files from db for not exist")
+        if quarantined:
+            conn.executemany("DELETE FROM quarantine WHERE file_path = ?", [(path,) for path in quarantined])
+        if unindexed:
+            conn.executemany("DELETE FROM unindexed WHERE file_path = ?", [(path,) for path in unindexed])
+        if unlisted:
+            store_unindexed(conn, unlisted)
+        conn.commit()
 
-    # 如果数据库不存在则创建数据库和重建索引目录
-    if not os.path.exists(db_file_path):
-        create_database(db_file_path)
-        # 如果重建数据库则重建索引目录
-        remove_index_dir(index_dir)
+        # 分批处理新文件和变化的文件
+        index_rows(conn, ix, jobs, config, pool)
+        remove_orphan_bodies(conn)
+        # 数据库与磁盘一致的时间，searcher 据此判断能否用数据库列出目录
+        set_meta(conn, 'last_full_scan', time.time())
+        conn.commit()
 
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
 
-    # 准备数据库指针
-    with sqlite3.connect(db_file_path) as conn:
-        cursor = conn.cursor()
-        # 扫描目录并将文件元数据插入数据库
-        for folder in config['folders']:
-            scan_folder(folder, conn)
-        
+    cursor.close()
 
-        # 准备索引指针
-        # 索引目录是否存在索引
-        if not exists_in(index_dir):
-            ix = create_index(index_dir)
+# 增量索引，只处理 watcher 传入的变更路径
+# changed_paths 为新建、修改或移入的文件或目录，deleted_paths 为删除或移出的文件或目录
+def index_changes(conn, ix, config, changed_paths, deleted_paths, pool=None):
+    cursor = conn.cursor()
+    deleted_paths = list(deleted_paths)
+
+    # 收集变更文件的属性，目录则扫描其下所有文件
+    # 新目录和其中的文件可能同时在变更路径中，按路径去重，同一个文件只解析一次
+    scan_started = time.perf_counter()
+    attributes = {}
+    for path in changed_paths:
+        if os.path.isdir(path):
+            for batch in scan_folders([path], config['max_scan_processes'], config['max_files_per_batch'], config['queue_size_limit']):
+                attributes.update((attr['file_path'], attr) for attr in batch)
+        elif os.path.isfile(path):
+            file_attributes = get_file_attributes(path)
+            if file_attributes:
+                attributes[file_attributes['file_path']] = file_attributes
         else:
-            ix = open_index(index_dir)
-        writer = ix.writer()
-
-
-        # 整理数据库，整理索引
-        # 删除、添加、更新
-        cursor.execute("SELECT i.file_path FROM indexed i LEFT JOIN chkchng c ON i.file_path = c.file_path WHERE c.file_path IS NULL")
-        delete_paths = [item[0] for item in cursor.fetchall()]
-
-        cursor.execute("SELECT i.file_path FROM indexed i INNER JOIN chkchng c ON i.file_path = c.file_path WHERE i.modification_time <> c.modification_time")
-        update_paths = [item[0] for item in cursor.fetchall()]
-
-        # 删除已经不存在文件的索引和删除有修改的文件的索引
-        remove_index_paths = delete_paths + update_paths
-        for remove_index_path in remove_index_paths:
-            delete_document_from_index(writer, remove_index_path)
-            logging.info(f"Deleted file from index: {remove_index_path}")
-        writer.commit()
+            # 事件发生后文件已不存在
+            deleted_paths.append(path)
+
+    # 删除的路径可能是文件，也可能是目录
+    remove_paths = set()
+    released_paths = set()
+    delisted_paths = set()
+    for path in deleted_paths:
+        cursor.execute("SELECT file_path FROM indexed WHERE file_path = ? OR (file_path >= ? AND file_path < ?)", (path, *path_prefix_range(path)))
+        remove_paths.update(item[0] for item in cursor.fetchall())
+        cursor.execute("SELECT file_path FROM quarantine WHERE file_path = ? OR (file_path >= ? AND file_path < ?)", (path, *path_prefix_range(path)))
+        released_paths.update(item[0] for item in cursor.fetchall())
+        cursor.execute("SELECT file_path FROM unindexed WHERE file_path = ? OR (file_path >= ? AND file_path < ?)", (path, *path_prefix_range(path)))
+        delisted_paths.update(item[0] for item in cursor.fetchall())
+
+    # 只处理新文件和指纹变化的文件，被隔离的文件没有变化时跳过
+    # 不支持解析的文件只记录到 unindexed 供目录列表使用
+    jobs = []
+    unlisted = []
+    skipped = 0
+    for attr in attributes.values():
+        if not is_supported(attr):
+            unlisted.append((attr['file_path'], attr['file_name'], attr['file_size'], attr['mtime_ns']))
+            continue
+        cursor.execute("SELECT file_size, COALESCE(mtime_ns, modification_time), content_hash FROM indexed WHERE file_path = ?", (attr['file_path'],))
+        indexed_row = cursor.fetchone()
+        if indexed_row and not fingerprint_changed(indexed_row[:2], attr):
+            continue
+        if indexed_row is None:
+            cursor.execute("SELECT file_size, mtime_ns FROM quarantine WHERE file_path = ?", (attr['file_path'],))
+            if is_quarantined(cursor.fetchone(), attr):
+                skipped += 1
+                unlisted.append((attr['file_path'], attr['file_name'], attr['file_size'], attr['mtime_ns']))
+                continue
+        jobs.append((attributes_to_row(attr), indexed_row is not None, indexed_row[2] if indexed_row else None))
+    SCAN_SECONDS.observe(time.perf_counter() - scan_started)
+    if skipped:
+        FILES_TOTAL.inc(skipped, status='quarantined')
+        logging.info(f"Skipped {skipped} quarantined files")
+
+    if released_paths or delisted_paths or unlisted:
+        conn.executemany("DELETE FROM quarantine WHERE file_path = ?", [(path,) for path in released_paths])
+        conn.executemany("DELETE FROM unindexed WHERE file_path = ?", [(path,) for path in delisted_paths])
+        store_unindexed(conn, unlisted)
+        conn.commit()
+    if not remove_paths and not jobs:
+        logging.info("No changes to index.")
+        return
 
-        # 删除 indexed 表中有的，但 chkchng 表中没有的数据
-        cursor.execute("DELETE FROM indexed WHERE file_path NOT IN (SELECT file_path FROM chkchng)")
-        logging.info(f"Deleted files from db for not exist {delete_paths}")
+    try:
+        if remove_paths:
+            remove_documents(conn, ix, remove_paths)
+        index_rows(conn, ix, jobs, config, pool)
+        remove_orphan_bodies(conn)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+    cursor.close()
 
-        # 删除 indexed 表中，那些 file_path 在 chkchng 表中也存在，但 modification_time 不同的记录
-        cursor.execute("DELETE FROM indexed WHERE EXISTS (SELECT 1 FROM chkchng WHERE chkchng.file_path = indexed.file_path AND chkchng.modification_time <> indexed.modification_time)")
-        logging.info(f"Deleted files from db for modified {delete_paths}")
+# 记录一次索引任务：开始时清空指标，结束后输出各阶段的耗时，并写入 summary_path 供 searcher 的 /metrics 读取
+@contextmanager
+def index_run(summary_path, kind):
+    REGISTRY.reset()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        write_run_summary(summary_path, kind, time.perf_counter() - started)
+
+def write_run_summary(summary_path, kind, seconds):
+    metrics = REGISTRY.snapshot()
+    for name, values in metrics.items():
+        items = list(values.items())
+        if items and isinstance(items[0][1], dict):
+            # 耗时按总和从大到小输出，便于找出最慢的格式
+            items.sort(key=lambda item: -item[1]['sum'])
+        for labels, value in items:
+            if isinstance(value, dict):
+                if value['count']:
+                    logging.info(f"{name}{labels}: {value['count']} in {value['sum']:.2f}s "
+                                 f"({value['sum'] / value['count'] * 1000:.1f} ms avg, {value['max'] * 1000:.1f} ms max)")
+            else:
+                logging.info(f"{name}{labels}: {value}")
+    logging.info(f"Finished {kind} index run in {seconds:.2f}s")
+    summary = {'kind': kind, 'finished_at': time.time(), 'seconds': round(seconds, 3), 'metrics': metrics}
+    tmp_path = summary_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, summary_path)
+    except OSError as e:
+        logging.error(f"Error writing index run summary {summary_path}: {e}")
+
+# 数据目录下各文件的路径
+def get_paths(script_dir):
+    return {
+        'script_dir': script_dir,
+        'config_path': os.path.join(script_dir, "data/config","config.ini"),
+        'log_file_path': os.path.join(script_dir, "data/logs","logs.log"),
+        'db_file_path': os.path.join(script_dir, "data", "index.db"),
+        'index_dir': os.path.join(script_dir, "data", "index_dir"),
+        'summary_path': os.path.join(script_dir, "data/logs", "index_summary.json"),
+    }
 
+# 准备日志文件和数据库
+def prepare_storage(paths):
+    # 如果日志文件不存在则创建
+    if not os.path.exists(paths['log_file_path']):
+        with open(paths['log_file_path'], 'a'):
+            os.utime(paths['log_file_path'], None)
 
+    # 如果数据库不存在则创建数据库和重建索引目录
+    if not os.path.exists(paths['db_file_path']):
+        create_database(paths['db_file_path'])
+        # 如果重建数据库则重建索引目录
+        remove_index_dir(paths['index_dir'])
+    else:
+        migrate_database(paths['db_file_path'])
+
+# 创建解析进程池，max_index_processes 不大于 1 且不限制解析时间和内存时返回 None，在当前进程中解析
+# 设置了解析限制时至少使用一个解析进程，超时或超出内存上限不会影响索引进程本身
+# 使用 forkserver 启动解析进程：watcher 进程中已有其他线程，直接 fork 不安全；
+# forkserver 预加载 jieba 词典后再 fork 出解析进程，各进程共享词典，见 startup.worker_context
+def create_parse_pool(paths, config):
+    max_workers = config['max_index_processes']
+    limited = config['parse_timeout'] > 0 or config['parse_memory_mb'] > 0
+    if max_workers <= 1 and not limited:
+        return None
+    initargs = (paths['log_file_path'], config['log_level'], config['parse_timeout'], config['parse_memory_mb'])
+    return ParsePool(max(1, max_workers), initargs)
+
+# 常驻索引服务
+# 在 watcher 进程内运行，解析进程池、jieba 词典和 Whoosh 索引句柄在多次索引之间保持常驻。
+# 任务通过队列提交，由单独的线程按顺序执行，submit_* 返回 Future，可等待任务完成。
+# 空闲 idle_seconds 秒后在后台合并索引段，每隔 optimize_interval 秒优化一次有变化的索引。
+class IndexerService:
+    idle_seconds = 60
+
+    def __init__(self, script_dir):
+        self.paths = get_paths(script_dir)
+        self.jobs = queue.Queue()
+        self.pool = None
+        self.thread = None
+        self.config = None
+        self.dirty = False
+        self.last_optimize = time.time()
+
+    def start(self):
+        startup_timer = StartupTimer("indexer service")
+        self.config = read_config(self.paths['config_path'], self.paths['script_dir'])
+        setup_logging(self.paths['log_file_path'], self.config['log_level'])
+        with startup_timer.stage("storage"):
+            prepare_storage(self.paths)
+        self.pool = create_parse_pool(self.paths, self.config)
+        if self.pool is None:
+            # 在本进程中解析时提前加载词典，第一次索引不用等待
+            with startup_timer.stage("jieba"):
+                load_jieba()
+        startup_timer.report()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit_full(self):
+        return self.submit('full')
+
+    def submit_changes(self, changed_paths, deleted_paths):
+        return self.submit('changes', list(changed_paths), list(deleted_paths))
+
+    def submit(self, kind, *args):
+        future = Future()
+        self.jobs.put((kind, args, future))
+        return future
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+        if self.pool:
+            self.pool.shutdown()
+
+    def run(self):
+        # SQLite 连接只能在创建它的线程中使用
+        conn = connect(self.paths['db_file_path'])
+        ix = open_or_create_index(self.paths['index_dir'])
         try:
-            # 查询需要处理的文件路径
-            writer = ix.writer()
-            cursor.execute("""
-                SELECT c.file_path, c.file_name, c.extension, c.file_type, 
-                    c.creation_time, c.modification_time, c.file_size, 
-                    c.is_hidden
-                FROM chkchng c
-                LEFT JOIN indexed i ON c.file_path = i.file_path
-                WHERE i.file_path IS NULL
-            """)
-
-            files_to_process = cursor.fetchall()
-            data_to_insert = []
-
-            for row in files_to_process:
-                file_path = row[0]
-                extension = row[2]
-
+            while True:
                 try:
-                    content = parse_file(file_path, extension)
-                    if content:
-                        # 构建需要插入的数据
-                        data_to_insert.append(row + ('indexed', content))
-                        # Whoosh 索引
-                        add_document_to_index(writer, file_path, row[1], content)  # 使用row[1]作为文件名
-                        logging.info(f"Parsed and indexed file: {file_path}")
-                    else:
-                        logging.error(f"Failed to parse file: {file_path}")           
-
+                    job = self.jobs.get(timeout=self.idle_seconds)
+                except queue.Empty:
+                    self.maintain(ix)
+                    continue
+                if job is None:
+                    break
+                kind, args, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    # 每次任务重新读取配置，以便使用新增的文件夹
+                    self.config = read_config(self.paths['config_path'], self.paths['script_dir'])
+                    with index_run(self.paths['summary_path'], kind):
+                        if kind == 'full':
+                            full_index(conn, ix, self.config, self.pool)
+                        else:
+                            index_changes(conn, ix, self.config, *args, pool=self.pool)
+                    self.dirty = True
+                    future.set_result(None)
                 except Exception as e:
-                    logging.error(f"Error processing file {file_path}: {e}")
-
-            # 批量插入数据
-            if data_to_insert:  
-                cursor.executemany("INSERT INTO indexed (file_path, file_name, extension, file_type, creation_time, modification_time, file_size, is_hidden, status, file_content) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", data_to_insert)
-                conn.commit()
-                logging.info(f"Indexed {len(data_to_insert)} files.")
-
+                    logging.error(f"An error occurred while indexing: {e}")
+                    future.set_exception(e)
+        finally:
+            conn.close()
+            ix.close()
+
+    # 空闲时维护索引：到期则优化为一个段，否则段过多时合并小段
+    def maintain(self, ix):
+        if not self.dirty:
+            return
+        try:
+            interval = self.config['optimize_interval']
+            if interval > 0 and time.time() - self.last_optimize >= interval:
+                before, after = merge_segments(ix, optimize=True)
+                logging.info(f"Optimized index segments: {before} -> {after}")
+                self.last_optimize = time.time()
+                self.dirty = False
+            else:
+                merge_if_needed(ix, self.config)
         except Exception as e:
-            conn.rollback()
+            logging.error(f"An error occurred while merging index: {e}")
+
+# 用数据库中已解析的内容重建 Whoosh 索引，不重新解析文件，返回 (新索引, 文档数)
+# 旧版本创建的索引对已分词的内容会再次用 ChineseAnalyzer 分词，重建后改用 SegmentedAnalyzer
+def rebuild_index(conn, index_dir, config):
+    remove_index_dir(index_dir)
+    ix = create_index(index_dir)
+    batch_size = max(1, config['max_files_per_batch'])
+    cursor = conn.execute("SELECT file_path, file_name, body FROM indexed JOIN blobs ON blobs.body_hash = indexed.body_hash")
+    total = 0
+    while rows := cursor.fetchmany(batch_size):
+        writer = get_writer(ix, limitmb=config['writer_limitmb'])
+        try:
+            for file_path, file_name, body in rows:
+                add_document_to_index(writer, file_path, file_name, decompress_body(body))
+            writer.commit(merge=False)
+        except Exception:
             writer.cancel()
-            logging.error(f"An error occurred: {e}")
+            raise
+        total += len(rows)
+    merge_segments(ix, optimize=True)
+    return ix, total
+
+# 解析最慢的 limit 个已索引文件和全部被隔离的文件，返回报告的各行
+def slow_files_report(conn, limit):
+    lines = [f"Slowest {limit} indexed files:"]
+    cursor = conn.execute(
+        "SELECT file_path, file_size, parse_seconds FROM indexed WHERE parse_seconds IS NOT NULL "
+        "ORDER BY parse_seconds DESC LIMIT ?", (limit,))
+    for file_path, file_size, parse_seconds in cursor:
+        lines.append(f"  {parse_seconds:8.2f}s  {file_size / 1024 / 1024:8.1f} MB  {file_path}")
+    rows = conn.execute(
+        "SELECT file_path, file_size, reason, parse_seconds, attempts, quarantined_at FROM quarantine "
+        "ORDER BY quarantined_at DESC").fetchall()
+    lines.append(f"Quarantined files ({len(rows)}):")
+    for file_path, file_size, reason, parse_seconds, attempts, quarantined_at in rows:
+        quarantined_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(quarantined_at))
+        lines.append(f"  {reason:<10}  {parse_seconds or 0:8.2f}s  {file_size / 1024 / 1024:8.1f} MB  "
+                     f"{attempts} attempts, last {quarantined_time}  {file_path}")
+    return lines
+
+# 命令行参数
+def parse_args():
+    parser = argparse.ArgumentParser(description="扫描、解析并索引文件")
+    parser.add_argument("--incremental", action="store_true",
+                        help="增量模式，从标准输入读取 JSON 格式的变更路径 {\"changed\": [...], \"deleted\": [...]}")
+    parser.add_argument("--optimize", action="store_true",
+                        help="将索引合并为一个段，并输出合并前后的段数量")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="用数据库中已解析的内容重建索引，需先停止 watcher 和 web 服务，完成后再启动")
+    parser.add_argument("--slow-files", type=int, nargs="?", const=20, metavar="N",
+                        help="输出解析最慢的 N 个文件（默认 20）和被隔离的文件")
+    parser.add_argument("--retry-quarantined", action="store_true",
+                        help="清空隔离记录，下次索引时重新解析被隔离的文件")
+    return parser.parse_args()
 
-        # 清空 chkchng 表
-        cursor.execute("DELETE FROM chkchng")
-        conn.commit()
+# 主函数
+def main():
+    startup_timer = StartupTimer("indexer")
+    args = parse_args()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = get_paths(script_dir)
 
-    cursor.close()
+    config = read_config(paths['config_path'], script_dir)
+    setup_logging(paths['log_file_path'], config['log_level'])
+    with startup_timer.stage("storage"):
+        prepare_storage(paths)
+
+    # 准备数据库指针
+    with connect(paths['db_file_path']) as conn:
+        # 准备索引指针
+        with startup_timer.stage("index"):
+            ix = open_or_create_index(paths['index_dir'])
+        startup_timer.report()
+        # 解析进程在第一次提交任务时才启动
+        indexing = not (args.optimize or args.rebuild or args.slow_files is not None or args.retry_quarantined)
+        pool = create_parse_pool(paths, config) if indexing else None
+        if args.slow_files is not None:
+            print("\n".join(slow_files_report(conn, args.slow_files)))
+        elif args.retry_quarantined:
+            cursor = conn.execute("DELETE FROM quarantine")
+            conn.commit()
+            message = f"Released {cursor.rowcount} quarantined files"
+            logging.info(message)
+            print(message)
+        elif args.optimize:
+            start_time = time.time()
+            before, after = merge_segments(ix, optimize=True)
+            message = f"Optimized index segments: {before} -> {after}, {ix.doc_count()} documents, {time.time() - start_time:.2f}s"
+            logging.info(message)
+            print(message)
+        elif args.rebuild:
+            ix.close()
+            start_time = time.time()
+            ix, total = rebuild_index(conn, paths['index_dir'], config)
+            message = f"Rebuilt index with {total} documents, {time.time() - start_time:.2f}s"
+            logging.info(message)
+            print(message)
+        elif args.incremental:
+            changes = json.load(sys.stdin)
+            with index_run(paths['summary_path'], 'changes'):
+                index_changes(conn, ix, config, changes.get('changed', []), changes.get('deleted', []), pool)
+            merge_if_needed(ix, config)
+        else:
+            with index_run(paths['summary_path'], 'full'):
+                full_index(conn, ix, config, pool)
+            merge_if_needed(ix, config)
+
+    if pool is not None:
+        pool.shutdown()
     conn.close()
-    writer.commit()
-    ix.close
+    ix.close()
 
 if __name__ == "__main__":
     main()
@@ -1,19 +1,23 @@
 import os
+import json
+import time
+import sqlite3
+import threading
 import logging.config
 import configparser
 import atexit
-import sqlite3
 from whoosh.index import open_dir
 from whoosh.qparser import QueryParser
 from flask import (
     Flask,
     request,
     render_template,
-    render_template_string,
     redirect,
     url_for,
     jsonify,
     Response,
+    stream_with_context,
+    g,
 )
 import markdown
 from markdown.extensions.toc import TocExtension
@@ -32,9 +36,18 @@ from markdown.extensions.meta import MetaExtension
 from markdown.extensions.abbr import AbbrExtension
 from markdown.extensions.legacy_em import LegacyEmExtension
 from markdown.extensions.md_in_html import MarkdownInHtmlExtension
-from bs4 import BeautifulSoup
-import re
 from urllib.parse import unquote
+from html import escape
+from database import connect, decompress_body, iter_body, path_prefix_range
+from streaming import iter_file_text, iter_lines, split_markdown_sections
+from cache import LRUCache, GenerationCache, DiskCache
+from startup import StartupTimer, load_jieba
+from metrics import REGISTRY, Registry
+from tokenizer import SearcherPool, parse_query, query_schema
+from highlighter import build_pattern, highlight_html, render_fragments, make_snippet
+
+# 统计启动耗时，使用 gunicorn --preload 时以下初始化只在 master 进程中执行一次
+startup_timer = StartupTimer("searcher")
 
 
 
@@ -63,6 +76,32 @@ DEL_BASE_DIR = tuple(
     [os.path.join(SCRIPT_DIR, "data", folder_name) for folder_name in FOLDER_NAMES]
 )
 
+# 搜索结果分页大小
+PAGE_SIZE = config.getint("Search", "page_size", fallback=50)
+MAX_PAGE_SIZE = config.getint("Search", "max_page_size", fallback=500)
+# 每个 worker 缓存的查询结果数
+QUERY_CACHE_SIZE = config.getint("Search", "query_cache_size", fallback=256)
+# JSON 接口中摘要包含匹配位置前后各 x 个字符
+SNIPPET_CONTEXT = config.getint("Search", "snippet_context", fallback=80)
+# 数据库超过 x 秒没有完成全量扫描时，目录列表从磁盘读取
+LISTING_MAX_AGE = config.getint("Search", "listing_max_age", fallback=10800)
+# 目录列表可用的排序方式与数据库列的对应关系
+LISTING_SORTS = {"name": "file_name", "mtime": "mtime_ns", "size": "file_size"}
+# 超过 x 个字符的文档先只显示匹配的片段
+FRAGMENT_THRESHOLD = config.getint("Render", "fragment_threshold", fallback=200000)
+FRAGMENT_CONTEXT = config.getint("Render", "fragment_context", fallback=200)
+MAX_FRAGMENTS = config.getint("Render", "max_fragments", fallback=50)
+# 渲染缓存的容量
+RENDER_CACHE_ITEMS = config.getint("Render", "render_cache_items", fallback=1024)
+RENDER_CACHE_MB = config.getint("Render", "render_cache_mb", fallback=64)
+RENDER_CACHE_DIR = config.get("Render", "render_cache_dir", fallback="").strip()
+RENDER_DISK_CACHE_MB = config.getint("Render", "render_disk_cache_mb", fallback=512)
+# 超过 x 个字符的文档分段渲染并流式输出
+STREAM_THRESHOLD = config.getint("Render", "stream_threshold", fallback=1000000)
+STREAM_SECTION_CHARS = config.getint("Render", "stream_section_chars", fallback=200000)
+# 流式输出每页的大小，超过后显示继续显示的链接
+STREAM_PAGE_BYTES = config.getint("Render", "stream_page_bytes", fallback=8 * 1024 * 1024)
+
 # 从配置文件中读取日志等级
 LOG_LEVEL = getattr(logging, config["Logging"]["log_level"].upper())
 
@@ -117,22 +156,64 @@ MARKDOWN_EXTENSIONS = [
 
 # 打开现有的 Whoosh 索引
 try:
-    ix = open_dir(INDEX_DIR)
+    with startup_timer.stage("index"):
+        ix = open_dir(INDEX_DIR)
 except Exception as e:
     logging.debug(f"Error opening index: {e}")
     exit(1)
 
+# 提前加载 jieba 词典和查询解析器，preload 时 fork 出的 worker 以写时复制的方式共享，第一次查询不用等待
+with startup_timer.stage("jieba"):
+    load_jieba()
+    query_parser = QueryParser("file_content", query_schema())
+
+
+# searcher 池和查询结果缓存，每个 worker 进程一份
+searcher_pool = SearcherPool(ix)
+query_cache = GenerationCache(QUERY_CACHE_SIZE)
+# 渲染后未高亮的 HTML，按文档内容的哈希缓存，内容相同的文件共用
+render_cache = LRUCache(RENDER_CACHE_ITEMS, RENDER_CACHE_MB * 1024 * 1024)
+disk_render_cache = (
+    DiskCache(os.path.join(BASE_DIR, RENDER_CACHE_DIR), RENDER_DISK_CACHE_MB * 1024 * 1024)
+    if RENDER_CACHE_DIR
+    else None
+)
+# 搜索和渲染的指标，由 /metrics 输出
+SEARCH_SECONDS = REGISTRY.histogram("search_seconds", "search_index 所用的时间，包括命中查询缓存的请求", ("kind",))
+SEARCH_ERRORS = REGISTRY.counter("search_errors_total", "搜索出错的次数", ("kind",))
+QUERY_PARSE_SECONDS = REGISTRY.histogram("search_query_parse_seconds", "解析查询所用的时间")
+QUERY_EXECUTE_SECONDS = REGISTRY.histogram("search_query_execute_seconds", "Whoosh 执行查询所用的时间")
+RENDER_SECONDS = REGISTRY.histogram("render_seconds", "render_file 生成响应所用的时间，流式输出只计到开始输出为止", ("mode",))
+# 索引器每次运行后写入的摘要，/metrics 读取后一并输出
+INDEX_SUMMARY_PATH = os.path.join(SCRIPT_DIR, "data/logs", "index_summary.json")
+# 渲染文件时复用的数据库连接，每个 worker 进程一个
+db_lock = threading.Lock()
+db_conn = None
+db_pid = None
+
 
 # 注册一个函数，在应用退出时关闭索引
 def close_index():
+    searcher_pool.close()
     ix.close()
 
 
 atexit.register(close_index)
+startup_timer.report(logger)
 
 
-def search_index(query_str):
+# 搜索并返回第 page 页的结果
+# 返回 {"results", "total", "exact", "page", "pagesize", "next_page"}，total 为命中总数，
+# exact 为 False 时 total 是 Whoosh 估算的数量；next_page 为下一页页码，没有更多结果时为 None
+# sort 和 descending 只用于 ls: 目录列表
+def search_index(query_str, page=1, pagesize=PAGE_SIZE, sort="name", descending=False):
     results = []
+    total = 0
+    exact = True
+    has_more = False
+    offset = (page - 1) * pagesize
+    kind = "root" if query_str == "root:" else "ls" if query_str.startswith("ls:") else "content"
+    started = time.perf_counter()
     try:
         if query_str == "root:":
             for folder_name in FOLDER_NAMES:
@@ -145,53 +226,203 @@ def search_index(query_str):
                         "score": 1,
                     }
                 )
+            total = len(results)
+            has_more = total > offset + pagesize
+            results = results[offset:offset + pagesize]
         elif query_str.startswith("ls:"):
             dir_name = query_str.split(":", 1)[1].strip()
             dir_path = os.path.join(BASE_DIR, dir_name)
-            if dir_path not in DEL_BASE_DIR:
-                return results
-            if os.path.isdir(dir_path):
-                for root, _, files in os.walk(dir_path):
-                    for file_name in files:
-                        file_path = os.path.join(root, file_name)
-                        folder_path = os.path.dirname(file_path)
-                        results.append(
-                            {
-                                "file_name": file_name,
-                                "file_path": file_path,
-                                "folder_path": folder_path,
-                                "score": 1,
-                            }
-                        )
-            else:
-                return results
-        else:
-            with ix.searcher() as searcher:
-                parser = QueryParser("file_content", ix.schema)
-                query = parser.parse(query_str)
-                for hit in searcher.search(query, limit=None):
-                    file_path = hit["file_path"]
-                    file_name = hit["file_name"]
-                    folder_path = os.path.dirname(file_path)
-                    folder_name = os.path.basename(folder_path)
-                    score = hit.score
+            if dir_path in DEL_BASE_DIR:
+                if listing_is_fresh():
+                    total, rows = list_indexed(dir_path, offset, pagesize, sort, descending)
+                elif os.path.isdir(dir_path):
+                    logger.info(f"Listing {dir_path} from disk, database is not up to date")
+                    rows = list_disk(dir_path, sort, descending)
+                    total = len(rows)
+                    rows = rows[offset:offset + pagesize]
+                else:
+                    rows = []
+                for file_path, file_name in rows:
                     results.append(
                         {
                             "file_name": file_name,
                             "file_path": file_path,
-                            "folder_path": folder_path,
-                            "folder_name": folder_name,
-                            "score": score,
+                            "folder_path": os.path.dirname(file_path),
+                            "score": 1,
                         }
                     )
+            has_more = total > offset + pagesize
+        else:
+            return search_content(query_str, page, pagesize)
     except Exception as e:
-        return results
-    return results
+        # 出错时返回空结果页，记录异常以便排查
+        logger.exception(f"Error searching {query_str!r}: {e}")
+        SEARCH_ERRORS.inc(kind=kind)
+        results = []
+        total = 0
+        has_more = False
+    finally:
+        SEARCH_SECONDS.observe(time.perf_counter() - started, kind=kind)
+    return {
+        "results": results,
+        "total": total,
+        "exact": exact,
+        "page": page,
+        "pagesize": pagesize,
+        "next_page": page + 1 if has_more else None,
+    }
+
+
+# 数据库在 LISTING_MAX_AGE 秒内完成过全量扫描时，可以直接用它列出目录
+def listing_is_fresh():
+    try:
+        row = query_db("SELECT value FROM meta WHERE key = ?", ("last_full_scan",))
+        query_db("SELECT 1 FROM unindexed LIMIT 1", ())
+    except sqlite3.OperationalError:
+        # 数据库还没有升级到有 meta 和 unindexed 表的版本
+        return False
+    if row is None:
+        return False
+    return LISTING_MAX_AGE <= 0 or time.time() - float(row[0]) <= LISTING_MAX_AGE
+
+
+# 从数据库中按路径前缀列出目录下的文件，返回 (文件总数, [(file_path, file_name), ...])
+# 已索引的文件在 indexed 表中，不支持解析和解析失败的文件在 unindexed 表中，合起来与磁盘上的文件一致
+# 路径范围查询使用 file_path 上的索引，排序和分页在 SQLite 中完成
+def list_indexed(dir_path, offset, limit, sort, descending):
+    start, end = path_prefix_range(dir_path)
+    files = (
+        "SELECT file_path, file_name, file_size, mtime_ns FROM indexed WHERE file_path >= ? AND file_path < ? "
+        "UNION ALL "
+        "SELECT file_path, file_name, file_size, mtime_ns FROM unindexed WHERE file_path >= ? AND file_path < ?"
+    )
+    total = query_db(f"SELECT COUNT(*) FROM ({files})", (start, end, start, end))[0]
+    order = f"{LISTING_SORTS[sort]} {'DESC' if descending else 'ASC'}, file_path"
+    rows = query_db(
+        f"SELECT file_path, file_name FROM ({files}) ORDER BY {order} LIMIT ? OFFSET ?",
+        (start, end, start, end, limit, offset),
+        fetchall=True,
+    )
+    return total, rows
+
+
+# 数据库过期时遍历磁盘列出目录下的所有文件并排序，返回 [(file_path, file_name), ...]
+def list_disk(dir_path, sort, descending):
+    entries = []
+    for root, _, files in os.walk(dir_path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            if sort == "name":
+                key = file_name
+            else:
+                try:
+                    file_stats = os.stat(file_path)
+                except OSError:
+                    continue
+                key = file_stats.st_mtime_ns if sort == "mtime" else file_stats.st_size
+            entries.append((key, file_path, file_name))
+    entries.sort(key=lambda entry: (entry[0], entry[1]), reverse=descending)
+    return [(file_path, file_name) for _, file_path, file_name in entries]
+
+
+# root: 和 ls: 是浏览目录而不是搜索
+def is_browse_query(query_str):
+    query_str = query_str.strip()
+    return query_str == "root:" or query_str.startswith("ls:")
+
+
+# 规范化查询字符串，去掉首尾空白并合并连续空白，作为缓存的键
+def normalize_query(query_str):
+    return " ".join(query_str.split())
+
+
+# 全文搜索，结果按索引版本缓存
+# 缓存的键包含索引版本，索引器提交后旧版本的结果不会再被命中
+def search_content(query_str, page, pagesize):
+    generation = ix.latest_generation()
+    query_cache.check_generation(generation)
+    cache_key = (generation, normalize_query(query_str), page, pagesize)
+    result_page = query_cache.get(cache_key)
+    if result_page is not None:
+        return result_page
+
+    results = []
+    offset = (page - 1) * pagesize
+    with searcher_pool.searcher() as searcher:
+        with QUERY_PARSE_SECONDS.time():
+            query = parse_query(query_str, query_parser)
+        # 只收集前 offset + pagesize + 1 个最高分的文档，多取一个用于判断是否还有下一页
+        with QUERY_EXECUTE_SECONDS.time():
+            hits = searcher.search(query, limit=offset + pagesize + 1)
+        total = hits.estimated_length()
+        exact = hits.has_exact_length()
+        has_more = hits.scored_length() > offset + pagesize
+        for hit in hits[offset:offset + pagesize]:
+            file_path = hit["file_path"]
+            file_name = hit["file_name"]
+            folder_path = os.path.dirname(file_path)
+            folder_name = os.path.basename(folder_path)
+            score = hit.score
+            results.append(
+                {
+                    "file_name": file_name,
+                    "file_path": file_path,
+                    "folder_path": folder_path,
+                    "folder_name": folder_name,
+                    "score": score,
+                }
+            )
+    result_page = {
+        "results": results,
+        "total": total,
+        "exact": exact,
+        "page": page,
+        "pagesize": pagesize,
+        "next_page": page + 1 if has_more else None,
+    }
+    query_cache.put(cache_key, result_page)
+    return result_page
+
+
+# 读取分页参数，非法值使用默认值
+def get_page_args():
+    page = request.args.get("page", 1, type=int)
+    # limit 是 pagesize 的别名，供 JSON 接口使用
+    pagesize = request.args.get("pagesize", request.args.get("limit", PAGE_SIZE, type=int), type=int)
+    return max(1, page), min(max(1, pagesize), MAX_PAGE_SIZE)
+
+
+# 读取目录列表的排序参数，sort 为 name、mtime 或 size，order=desc 时倒序
+def get_sort_args():
+    sort = request.args.get("sort", "name")
+    if sort not in LISTING_SORTS:
+        sort = "name"
+    return sort, request.args.get("order") == "desc"
 
 
 app = Flask(__name__)
 
 
+REQUEST_SECONDS = REGISTRY.histogram("request_seconds", "各接口处理请求所用的时间，流式输出只计到开始输出为止", ("endpoint",))
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+# 记录请求耗时，render_file 另按渲染方式记录
+@app.after_request
+def record_request(response):
+    started = g.get("request_started")
+    if started is not None and request.endpoint:
+        seconds = time.perf_counter() - started
+        REQUEST_SECONDS.observe(seconds, endpoint=request.endpoint)
+        if request.endpoint == "render_file":
+            RENDER_SECONDS.observe(seconds, mode=g.get("render_mode", "other"))
+    return response
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -204,73 +435,201 @@ def search():
         return redirect(url_for("index"))
 
     try:
-        results = search_index(query_str)
-        return render_template("results.html", query=query_str, results=results)
+        page, pagesize = get_page_args()
+        sort, descending = get_sort_args()
+        result_page = search_index(query_str, page, pagesize, sort, descending)
+        # 加载更多时只返回结果列表项，下一页页码放在响应头中
+        if request.args.get("partial"):
+            response = Response(
+                render_template("results_items.html", results=result_page["results"])
+            )
+            response.headers["X-Next-Page"] = str(result_page["next_page"] or "")
+            response.headers["X-Total"] = str(result_page["total"])
+            return response
+        return render_template(
+            "results.html", query=query_str, sort=sort, order="desc" if descending else "asc", **result_page
+        )
     except Exception as e:
         return redirect(url_for("index")), 500
 
 
+# JSON 接口可以选择返回的字段
+API_FIELDS = ("path", "name", "score", "snippet")
+API_DEFAULT_FIELDS = ("path", "name", "score")
+
+
+# 将搜索结果转换为只包含所选字段的字典
+def project_result(result, fields, query_str, bodies):
+    path = result.get("file_path") or result["folder_path"]
+    item = {}
+    for field in fields:
+        if field == "path":
+            item["path"] = path
+        elif field == "name":
+            item["name"] = result["file_name"]
+        elif field == "score":
+            item["score"] = result["score"]
+        elif field == "snippet":
+            body = bodies.get(path)
+            item["snippet"] = make_snippet(iter_body(body), query_str, SNIPPET_CONTEXT) if body else ""
+    return item
+
+
+# 读取一页结果的压缩内容，返回 {file_path: body}，只有需要摘要时才查询
+def load_bodies(results):
+    paths = [result["file_path"] for result in results if result.get("file_path")]
+    if not paths:
+        return {}
+    placeholders = ",".join("?" * len(paths))
+    rows = query_db(
+        f"SELECT indexed.file_path, blobs.body FROM indexed JOIN blobs ON blobs.body_hash = indexed.body_hash WHERE indexed.file_path IN ({placeholders})",
+        paths,
+        fetchall=True,
+    )
+    return dict(rows)
+
+
+@app.route("/api/search", methods=["GET"])
+def api_search():
+    started = time.perf_counter()
+    query_str = request.args.get("q", "").strip()
+    if not query_str:
+        return jsonify({"error": "缺少查询参数 q"}), 400
+    fields = [field.strip() for field in request.args.get("fields", ",".join(API_DEFAULT_FIELDS)).split(",") if field.strip()]
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown:
+        return jsonify({"error": f"不支持的字段: {', '.join(unknown)}", "fields": API_FIELDS}), 400
+
+    page, pagesize = get_page_args()
+    sort, descending = get_sort_args()
+    result_page = search_index(query_str, page, pagesize, sort, descending)
+    search_ms = (time.perf_counter() - started) * 1000
+    bodies = load_bodies(result_page["results"]) if "snippet" in fields else {}
+    meta = {
+        "query": query_str,
+        "page": result_page["page"],
+        "pagesize": result_page["pagesize"],
+        "total": result_page["total"],
+        "exact": result_page["exact"],
+        "next_page": result_page["next_page"],
+    }
+
+    # NDJSON：第一行为分页信息，之后每行一个结果，最后一行为耗时
+    if request.args.get("format") == "ndjson":
+        def generate():
+            yield json.dumps(meta, ensure_ascii=False) + "\n"
+            for result in result_page["results"]:
+                yield json.dumps(project_result(result, fields, query_str, bodies), ensure_ascii=False) + "\n"
+            timing = {"search_ms": round(search_ms, 3), "total_ms": round((time.perf_counter() - started) * 1000, 3)}
+            yield json.dumps({"timing": timing}) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    results = [project_result(result, fields, query_str, bodies) for result in result_page["results"]]
+    meta["results"] = results
+    meta["timing"] = {"search_ms": round(search_ms, 3), "total_ms": round((time.perf_counter() - started) * 1000, 3)}
+    return Response(json.dumps(meta, ensure_ascii=False), mimetype="application/json")
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "query_cache": query_cache.stats(),
+            "searcher_pool": searcher_pool.stats(),
+            "render_cache": render_cache.stats(),
+            "disk_render_cache": disk_render_cache.stats() if disk_render_cache else None,
+        }
+    )
+
+
+# Prometheus 格式的指标：本 worker 的搜索和渲染耗时、缓存状态，以及索引器最近一次运行的摘要
+@app.route("/metrics")
+def metrics():
+    scrape = Registry()
+    cache_gauge = scrape.gauge("cache", "各缓存的统计信息", ("cache", "stat"))
+    for cache_name, stats in (
+        ("query", query_cache.stats()),
+        ("render", render_cache.stats()),
+        ("disk_render", disk_render_cache.stats() if disk_render_cache else {}),
+        ("searcher_pool", searcher_pool.stats()),
+    ):
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)):
+                cache_gauge.set(value, cache=cache_name, stat=stat)
+    try:
+        with open(INDEX_SUMMARY_PATH, encoding="utf-8") as file:
+            summary = json.load(file)
+    except (OSError, ValueError):
+        summary = None
+    if summary:
+        scrape.gauge("indexer_last_run_timestamp_seconds", "索引器最近一次运行结束的时间").set(summary["finished_at"])
+        scrape.gauge("indexer_last_run_seconds", "索引器最近一次运行所用的时间", ("kind",)).set(
+            summary["seconds"], kind=summary["kind"]
+        )
+        stage_seconds = scrape.gauge("indexer_last_run_stage_seconds", "索引器最近一次运行中各阶段的总耗时", ("metric", "labels"))
+        stage_count = scrape.gauge("indexer_last_run_stage_count", "索引器最近一次运行中各阶段的次数", ("metric", "labels"))
+        for name, values in summary["metrics"].items():
+            for labels, value in values.items():
+                if isinstance(value, dict):
+                    stage_seconds.set(value["sum"], metric=name, labels=labels)
+                    stage_count.set(value["count"], metric=name, labels=labels)
+                else:
+                    stage_count.set(value, metric=name, labels=labels)
+    try:
+        quarantined = query_db("SELECT reason, COUNT(*) FROM quarantine GROUP BY reason", (), fetchall=True)
+    except sqlite3.Error:
+        # indexer 尚未升级数据库
+        quarantined = []
+    quarantine_gauge = scrape.gauge("quarantined_files", "因解析失败被隔离的文件数", ("reason",))
+    for reason, count in quarantined:
+        quarantine_gauge.set(count, reason=reason)
+    return Response(REGISTRY.render() + scrape.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/iframe_default")
 def iframe_default():
     return render_template("iframe_default.html")
 
 
-@app.route("/render_file")
-def render_file():
-    file_path = request.args.get("path")
-    query_str = request.args.get("query")
+# 在共享的数据库连接上执行查询，返回第一行，fetchall 为 True 时返回全部行
+def query_db(sql, params, fetchall=False):
+    global db_conn, db_pid
+    with db_lock:
+        if db_conn is None or db_pid != os.getpid():
+            db_conn = connect(db_file_path, check_same_thread=False)
+            db_pid = os.getpid()
+        cursor = db_conn.execute(sql, params)
+        return cursor.fetchall() if fetchall else cursor.fetchone()
 
-    # 解码文件路径
-    file_path = unquote(file_path)
 
-    if not file_path or not os.path.exists(file_path):
-        return render_template("iframe_default.html"), 404
+# 读取并解压文档内容，文件未索引时返回空字符串
+def load_content(body_hash):
+    row = query_db("SELECT body FROM blobs WHERE body_hash = ?", (body_hash,)) if body_hash else None
+    return decompress_body(row[0]) if row else ""
 
-    try:
-        file_extension = os.path.splitext(file_path)[1]
 
-        if file_extension in ['.docx', '.doc', '.pptx', '.ppt', '.xlsx', '.xls', '.csv', '.json', '.xml','.md']:
-            with sqlite3.connect(db_file_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT file_content FROM indexed WHERE file_path = ?", (file_path,))
-                row = cursor.fetchone()
-                if row:
-                    content = row[0]
-                else:
-                    content = ""
-            rendered_content = markdown.markdown(
-                content, extensions=MARKDOWN_EXTENSIONS
-            )
-            if query_str:
-                soup = BeautifulSoup(rendered_content, "html.parser")
-                pattern = re.compile(re.escape(query_str), re.IGNORECASE)
-                for text_node in soup.find_all(text=True):
-                    if text_node.parent.name not in [
-                        "script",
-                        "style",
-                        "code",
-                    ]:
-                        highlighted_text = pattern.sub(
-                            f'<span style="background-color: yellow;">{query_str}</span>',
-                            text_node,
-                        )
-                        text_node.replace_with(
-                            BeautifulSoup(highlighted_text, "html.parser")
-                        )
-                rendered_content = str(soup)
-            custom_css_link = "<link rel=\"stylesheet\" href=\"{{ url_for('static', filename='markdown_styles.css') }}\">"
-            rendered_content = render_template_string(
-                f"{custom_css_link}<div>{rendered_content}</div>", url_for=url_for
-            )
-        elif file_extension == ".html":
-            with open(file_path, "r", encoding="utf-8") as file:
-                rendered_content = file.read()
-        else:
-            with open(file_path, "rb") as file:
-                content = file.read()
-            rendered_content = f"<html><body><pre>{content.decode('utf-8', errors='replace')}</pre></body></html>"
+# 读取渲染缓存，先查内存再查磁盘，未命中时返回 None
+def get_cached_render(body_hash):
+    rendered = render_cache.get(body_hash)
+    if rendered is None and disk_render_cache is not None:
+        data = disk_render_cache.get(body_hash)
+        if data is not None:
+            rendered = data.decode("utf-8")
+            render_cache.put(body_hash, rendered)
+    return rendered
 
-        rendered_content += """
+
+# 写入渲染缓存
+def put_cached_render(body_hash, rendered):
+    render_cache.put(body_hash, rendered)
+    if disk_render_cache is not None:
+        disk_render_cache.put(body_hash, rendered.encode("utf-8"))
+
+
+# 预览页面中处理左右滑动的脚本，追加在每个预览页面的末尾
+SWIPE_SCRIPT = """
         <script>
             let touchStartX = 0;
             let touchEndX = 0;
@@ -295,6 +654,129 @@ def render_file():
         </script>
         """
 
+
+# 分段渲染大文档，从第 section 段开始，输出超过 STREAM_PAGE_BYTES 后给出继续显示的链接
+def stream_markdown(file_path, query_str, body, pattern, section):
+    css_link = url_for("static", filename="markdown_styles.css")
+    yield f'<link rel="stylesheet" href="{css_link}"><div>'
+    try:
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        sections = split_markdown_sections(iter_lines(iter_body(body)), STREAM_SECTION_CHARS)
+        sent = 0
+        for index, text in enumerate(sections):
+            if index < section:
+                continue
+            if sent >= STREAM_PAGE_BYTES:
+                next_url = url_for(
+                    "render_file", path=file_path, query=query_str or "", full=1, section=index
+                )
+                yield f'<p><a href="{escape(next_url)}">继续显示</a></p>'
+                break
+            rendered = md.reset().convert(text)
+            if pattern:
+                rendered = highlight_html(rendered, pattern)
+            sent += len(text)
+            yield rendered
+    except Exception as e:
+        logger.error(f"Error rendering file {file_path}: {e}")
+        yield f"<p>An error occurred: {escape(str(e))}</p>"
+    yield "</div>" + SWIPE_SCRIPT
+
+
+# 流式输出文件中从 offset 开始的 length 个字节，escape_text 为 True 时作为纯文本显示
+def stream_file(file_path, offset=0, length=None, escape_text=True):
+    if escape_text:
+        yield "<html><body><pre>"
+    try:
+        for text in iter_file_text(file_path, offset, length):
+            yield escape(text) if escape_text else text
+    except Exception as e:
+        logger.error(f"Error reading file {file_path}: {e}")
+        yield f"Error reading file: {escape(str(e))}"
+    if escape_text:
+        yield "</pre>"
+        if length is not None and offset + length < os.path.getsize(file_path):
+            next_url = url_for("render_file", path=file_path, offset=offset + length, length=length)
+            yield f'<p><a href="{escape(next_url)}">继续显示</a></p>'
+        yield "</body></html>"
+    yield SWIPE_SCRIPT
+
+
+@app.route("/render_file")
+def render_file():
+    file_path = request.args.get("path")
+    query_str = request.args.get("query")
+    # 从目录列表打开的文件不高亮，也不显示片段
+    if query_str and is_browse_query(query_str):
+        query_str = None
+
+    # 解码文件路径
+    file_path = unquote(file_path)
+
+    if not file_path or not os.path.exists(file_path):
+        return render_template("iframe_default.html"), 404
+
+    try:
+        file_extension = os.path.splitext(file_path)[1]
+
+        if file_extension in ['.docx', '.doc', '.pptx', '.ppt', '.xlsx', '.xls', '.csv', '.json', '.xml','.md']:
+            pattern = build_pattern(query_str) if query_str else None
+            full = request.args.get("full")
+            row = query_db(
+                "SELECT indexed.body_hash, blobs.length FROM indexed JOIN blobs ON blobs.body_hash = indexed.body_hash WHERE indexed.file_path = ?",
+                (file_path,),
+            )
+            body_hash, content_length = row if row else (None, 0)
+            # 大文档先只显示匹配的片段，full=1 时渲染全文
+            # 逐块解压查找片段，找够片段后不再解压，不会把整个文档解压到内存中
+            if pattern and content_length > FRAGMENT_THRESHOLD and not full:
+                g.render_mode = "fragments"
+                full_url = url_for("render_file", path=file_path, query=query_str, full=1)
+                body = query_db("SELECT body FROM blobs WHERE body_hash = ?", (body_hash,))[0]
+                rendered_content = render_fragments(
+                    iter_body(body), query_str, full_url, FRAGMENT_CONTEXT, MAX_FRAGMENTS
+                )
+            # 超大文档分段渲染并流式输出，不缓存
+            elif content_length > STREAM_THRESHOLD:
+                g.render_mode = "stream"
+                body = query_db("SELECT body FROM blobs WHERE body_hash = ?", (body_hash,))[0]
+                section = max(0, request.args.get("section", 0, type=int))
+                return Response(
+                    stream_with_context(stream_markdown(file_path, query_str, body, pattern, section)),
+                    mimetype="text/html",
+                )
+            else:
+                rendered_content = get_cached_render(body_hash) if body_hash else None
+                g.render_mode = "cached"
+                if rendered_content is None:
+                    g.render_mode = "markdown"
+                    # 缓存未命中时才读取并解压文档内容
+                    rendered_content = markdown.markdown(
+                        load_content(body_hash), extensions=MARKDOWN_EXTENSIONS
+                    )
+                    if body_hash:
+                        put_cached_render(body_hash, rendered_content)
+                # 缓存中是未高亮的 HTML，高亮按查询单独处理
+                if pattern:
+                    rendered_content = highlight_html(rendered_content, pattern)
+            custom_css_link = f'<link rel="stylesheet" href="{url_for("static", filename="markdown_styles.css")}">'
+            rendered_content = f"{custom_css_link}<div>{rendered_content}</div>"
+        elif file_extension == ".html":
+            g.render_mode = "html"
+            return Response(
+                stream_with_context(stream_file(file_path, escape_text=False)), mimetype="text/html"
+            )
+        else:
+            # 其他文件按字节范围流式输出，默认每次 STREAM_PAGE_BYTES 字节
+            g.render_mode = "raw"
+            offset = max(0, request.args.get("offset", 0, type=int))
+            length = max(1, request.args.get("length", STREAM_PAGE_BYTES, type=int))
+            return Response(
+                stream_with_context(stream_file(file_path, offset, length)), mimetype="text/html"
+            )
+
+        rendered_content += SWIPE_SCRIPT
+
         return rendered_content
     except UnicodeDecodeError as e:
         return Response(f"Error reading file: {str(e)}", status=500), 500
@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+
+def process_uptime():
+    """
+    返回当前进程从启动到现在的秒数，用于统计模块导入的耗时。
+    读取 /proc，非 Linux 系统上返回 None。
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # 进程名中可能有空格，从最后一个 ')' 之后开始分割，starttime 是第 22 个字段
+            start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+class StartupTimer:
+    """
+    记录启动各阶段的耗时，启动完成后输出一行汇总。
+
+    创建时记录进程已运行的时间作为 imports 阶段，之后用 stage() 记录各阶段。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = []
+        self.import_seconds = process_uptime()
+        if self.import_seconds is not None:
+            self.stages.append(("imports", self.import_seconds))
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+        以 with 语句记录一个阶段的耗时。
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((stage_name, time.perf_counter() - started))
+
+    def report(self, logger=logging):
+        """
+        输出并返回启动耗时的汇总。
+        """
+        stages = ", ".join(f"{stage_name} {seconds:.3f}s" for stage_name, seconds in self.stages)
+        total = (self.import_seconds or 0.0) + time.perf_counter() - self.started
+        message = f"{self.name} started in {total:.3f}s ({stages})"
+        logger.info(message)
+        return message
+
+
+def load_jieba():
+    """
+    加载 jieba 词典，已加载时直接返回。返回加载耗时（秒）。
+    """
+    import jieba
+    started = time.perf_counter()
+    jieba.initialize()
+    return time.perf_counter() - started
+
+
+def worker_context():
+    """
+    返回解析进程池使用的 multiprocessing 上下文。
+    使用 forkserver，forkserver 进程启动时导入 worker_preload 加载 jieba 词典和解析模块，
+    解析进程都从 forkserver fork 出来，以写时复制的方式共享已加载的词典，不需要各自加载。
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["worker_preload"])
+    return context
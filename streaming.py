@@ -0,0 +1,94 @@
+import re
+import codecs
+
+
+# 代码块的开始和结束标记
+FENCE_PATTERN = re.compile(r"^\s{0,3}(`{3,}|~{3,})")
+# 表格表头下的分隔行，如 | --- | :---: |
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+
+
+def iter_file_text(file_path, offset=0, length=None, chunk_size=64 * 1024):
+    """
+    按块读取文件中从 offset 开始的 length 个字节，增量解码为 UTF-8 文本。
+    多字节字符跨块时不会被截断；offset 落在字符中间时跳过残缺的字节，结尾落在字符中间时读完该字符。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(file_path, "rb") as file:
+        file.seek(offset)
+        remaining = length
+        first = offset > 0
+        while remaining is None or remaining > 0:
+            chunk = file.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            if first:
+                # UTF-8 后续字节为 0b10xxxxxx
+                skip = 0
+                while skip < min(3, len(chunk)) and chunk[skip] & 0xC0 == 0x80:
+                    skip += 1
+                chunk = chunk[skip:]
+                first = False
+            yield decoder.decode(chunk)
+        # 范围的结尾落在字符中间时多读几个字节补全该字符，下一段开头会跳过这些字节
+        extra = 0
+        while remaining is not None and decoder.getstate()[0] and extra < 3:
+            byte = file.read(1)
+            if not byte:
+                break
+            extra += 1
+            yield decoder.decode(byte)
+    yield decoder.decode(b"", final=True)
+
+
+def iter_lines(chunks):
+    """
+    将文本块重新切分为行，每行保留结尾的换行符。
+    """
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    if pending:
+        yield pending
+
+
+def split_markdown_sections(lines, section_chars=200000):
+    """
+    将 Markdown 按空行切分为大约 section_chars 个字符的段，每段可以单独渲染。
+    不在代码块中间切分；超长的表格在行之间切分，新的一段重复表头。
+    """
+    section = []
+    size = 0
+    fence = None
+    table_header = None
+    previous = None
+    for line in lines:
+        stripped = line.strip()
+        match = FENCE_PATTERN.match(line)
+        if fence:
+            if match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence):
+                fence = None
+        elif match:
+            fence = match.group(1)
+        elif not stripped:
+            table_header = None
+        elif table_header is None and previous and "|" in previous and TABLE_SEPARATOR_PATTERN.match(line):
+            table_header = [previous, line]
+        elif table_header and size >= section_chars:
+            yield "".join(section)
+            section = list(table_header)
+            size = sum(map(len, section))
+        section.append(line)
+        size += len(line)
+        previous = line
+        if not fence and not stripped and size >= section_chars:
+            yield "".join(section)
+            section = []
+            size = 0
+    if section:
+        yield "".join(section)
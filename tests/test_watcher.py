@@ -0,0 +1,28 @@
+from watchdog.events import DirModifiedEvent, FileCreatedEvent, FileDeletedEvent, FileMovedEvent
+
+from watcher import FileChangeHandler
+
+
+def make_handler():
+    # 不启动分发线程，只检查事件是否记录到 pending
+    return FileChangeHandler(30, indexer_service=None)
+
+
+def test_dispatch_records_created_file():
+    handler = make_handler()
+    handler.dispatch(FileCreatedEvent("/data/input/a.md"))
+    assert handler.pending == {"/data/input/a.md": "changed"}
+
+
+def test_dispatch_coalesces_events_by_path():
+    handler = make_handler()
+    handler.dispatch(FileCreatedEvent("/data/input/a.md"))
+    handler.dispatch(FileDeletedEvent("/data/input/a.md"))
+    handler.dispatch(FileMovedEvent("/data/input/b.md", "/data/input/c.md"))
+    handler.dispatch(DirModifiedEvent("/data/input"))
+    assert handler.pending == {
+        "/data/input/a.md": "deleted",
+        "/data/input/b.md": "deleted",
+        "/data/input/c.md": "changed",
+    }
+    assert handler.event_count == 4
@@ -1,15 +1,38 @@
 import os
 import logging
+import re
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 from whoosh.fields import Schema, TEXT, ID
 from whoosh.index import create_in, open_dir
-import jieba.analyse
-from jieba.analyse import ChineseAnalyzer
+from whoosh.reading import SegmentReader
+from whoosh.analysis import RegexTokenizer, LowercaseFilter, StopFilter, StemFilter
+from whoosh.lang.porter import stem
+from whoosh.query import Term, And, Or, NullQuery
+import jieba
 
 
 
 
 
 
+# 查询中出现这些语法时交给 QueryParser 解析
+QUERY_SYNTAX = re.compile(r'[:"*?~^()\[\]{}\']|\b(?:AND|OR|NOT|ANDNOT|ANDMAYBE)\b')
+
+
+def SegmentedAnalyzer():
+    """
+    已分词文本的分析器。
+    内容在写入索引前已由 segment_content 用 jieba 分词，这里只按空白切分，
+    再做与 ChineseAnalyzer 相同的过滤（去掉单个非中文字符、小写、停用词、词干），避免重复分词。
+    导入 jieba.analyse 时会加载关键词提取用的 IDF 词典，较慢，只在需要时导入。
+    """
+    from jieba.analyse.analyzer import STOP_WORDS
+    return (RegexTokenizer(r"[^\s]{2,}|[\u4E00-\u9FD5]") | LowercaseFilter() |
+            StopFilter(stoplist=STOP_WORDS, minsize=1) |
+            StemFilter(stemfn=stem, ignore=None, cachesize=50000))
+
 def create_index(index_dir):
     """
     创建 Whoosh 索引
@@ -17,11 +40,23 @@ def create_index(index_dir):
     schema = Schema(
         file_name=TEXT(stored=True),
         file_path=ID(stored=True),
-        file_content=TEXT(analyzer=ChineseAnalyzer())
+        file_content=TEXT(analyzer=SegmentedAnalyzer())
     )
     ix = create_in(index_dir, schema)
     return ix
 
+def query_schema():
+    """
+    QueryParser 使用的 schema。
+    file_content 使用 ChineseAnalyzer，对原始查询做与索引时相同的 jieba 搜索模式分词和过滤。
+    """
+    from jieba.analyse import ChineseAnalyzer
+    return Schema(
+        file_name=TEXT(stored=True),
+        file_path=ID(stored=True),
+        file_content=TEXT(analyzer=ChineseAnalyzer())
+    )
+
 def open_index(index_dir):
     """
     打开 Whoosh 索引
@@ -30,22 +65,207 @@ def open_index(index_dir):
     logging.debug("Opened existing index")
     return ix
 
-def add_document_to_index(writer, file_path, file_name, file_content):
+def segment_content(file_name, file_content):
+    """
+    使用 jieba 对文件名和文件内容进行分词，返回以空格分隔的字符串。
+    """
+    file_content = str(file_name + "\n" + file_content)
+    return " ".join(jieba.cut_for_search(file_content, HMM=True))
+
+@lru_cache(maxsize=4096)
+def segment_query(query_str):
+    """
+    使用与索引相同的词典对查询分词，结果缓存。
+    先用精确模式切出词，每个词再用与 segment_content 相同的搜索模式切出子词。
+    返回 ((词, (子词, ...)), ...)。
+    """
+    words = []
+    for word in jieba.cut(query_str, HMM=True):
+        word = word.strip()
+        if word:
+            words.append((word, tuple(jieba.cut_for_search(word, HMM=True))))
+    return tuple(words)
+
+@lru_cache(maxsize=1)
+def default_analyzer():
+    return SegmentedAnalyzer()
+
+def analyze_terms(text, analyzer=None):
+    """
+    将已分好的词规范化为索引中的词项（小写、去停用词、词干）。
+    """
+    if analyzer is None:
+        analyzer = default_analyzer()
+    return [token.text for token in analyzer(text)]
+
+def build_query(query_str, fieldname="file_content"):
+    """
+    将普通查询转换为 Whoosh 查询，各个词之间为 AND 关系。
+    每个词匹配完整的词项，或者同时匹配它的全部子词，文档中该词被切分成不同形式时也能命中。
+    """
+    clauses = []
+    for word, grams in segment_query(query_str):
+        whole = analyze_terms(word)
+        whole_term = whole[0] if len(whole) == 1 else None
+        terms = dict.fromkeys(term for gram in grams for term in analyze_terms(gram))
+        subterms = [Term(fieldname, term) for term in terms if term != whole_term]
+        if whole_term is None:
+            if subterms:
+                clauses.append(And(subterms) if len(subterms) > 1 else subterms[0])
+        elif subterms:
+            clauses.append(Or([Term(fieldname, whole_term), And(subterms)]))
+        else:
+            clauses.append(Term(fieldname, whole_term))
+    if not clauses:
+        return NullQuery
+    return And(clauses) if len(clauses) > 1 else clauses[0]
+
+def parse_query(query_str, parser, fieldname="file_content"):
+    """
+    解析搜索框中的查询。
+    带有字段、短语、通配符或布尔运算符等语法的查询交给 parser 解析，其余的用 build_query 构造。
+    """
+    if QUERY_SYNTAX.search(query_str):
+        return parser.parse(query_str)
+    return build_query(query_str, fieldname)
+
+def get_writer(ix, procs=1, limitmb=128, multisegment=False):
+    """
+    打开 Whoosh writer。
+    procs 大于 1 时使用多进程写入；multisegment 为 True 时各进程直接写出自己的段，提交时不合并，适合批量导入。
+    """
+    if procs > 1:
+        return ix.writer(procs=procs, limitmb=limitmb, multisegment=multisegment)
+    return ix.writer(limitmb=limitmb)
+
+def segment_count(ix):
+    """
+    返回索引当前的段数量。
+    """
+    return len(ix._segments())
+
+def merge_smallest(keep):
+    """
+    Whoosh 合并策略：保留文档数最多的 keep 个段，其余较小的段合并为一个新段。
+    """
+    def merge_policy(writer, segments):
+        if len(segments) <= keep + 1:
+            return segments
+        ordered = sorted(segments, key=lambda segment: segment.doc_count_all(), reverse=True)
+        for segment in ordered[keep:]:
+            reader = SegmentReader(writer.storage, writer.schema, segment)
+            writer.add_reader(reader)
+            reader.close()
+        return ordered[:keep]
+    return merge_policy
+
+def merge_segments(ix, optimize=False, keep=5):
+    """
+    合并索引段，返回 (合并前段数, 合并后段数)。
+    optimize 为 True 时合并为一个段，否则保留最大的 keep 个段，只合并其余较小的段。
+    """
+    before = segment_count(ix)
+    if optimize:
+        ix.optimize()
+    else:
+        writer = ix.writer()
+        writer.commit(mergetype=merge_smallest(keep))
+    after = segment_count(ix)
+    logging.debug(f"Merged index segments: {before} -> {after}")
+    return before, after
+
+def add_document_to_index(writer, file_path, file_name, file_content, segmented_content=None):
     """
     将文档添加到 Whoosh 索引中。
+    如果已在索引进程中完成分词，可通过 segmented_content 传入，避免重复分词。
     """
-    file_content = str(file_name + file_content)
-    segmented_content = " ".join(jieba.cut_for_search(file_content, HMM=True))
+    if segmented_content is None:
+        segmented_content = segment_content(file_name, file_content)
     writer.add_document(file_name=file_name, file_path=file_path, file_content=segmented_content)
     logging.debug(f"Indexed file: {file_path}")
 
-def delete_document_from_index(writer, file_path):
+def delete_document_from_index(writer, file_path, searcher=None):
     """
     从 Whoosh 索引中删除指定的文档。
+    批量删除时传入同一个 searcher，避免每次删除都重新打开 reader。
     """
-    writer.delete_by_term("file_path", file_path)
+    writer.delete_by_term("file_path", file_path, searcher=searcher)
     logging.debug(f"Deleted file from index: {file_path}")
 
+class SearcherPool:
+    """
+    Whoosh searcher 池，在多个请求之间复用已打开的 searcher。
+
+    每个 searcher 同一时间只借给一个请求使用。借出时如果索引已有新的版本，
+    调用 refresh() 打开新版本，未变化的段 reader 直接复用，已不存在的段由 Whoosh 关闭。
+    空闲的 searcher 超过 max_idle 个时关闭多余的。
+    进程 fork 后不再使用父进程打开的 searcher，在子进程中重新创建。
+    """
+
+    def __init__(self, ix, max_idle=4):
+        self.ix = ix
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+        self.opened = 0
+        self.refreshed = 0
+
+    def acquire(self):
+        """
+        借出一个与最新索引版本一致的 searcher。
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # 父进程的 searcher 与子进程共享文件句柄，直接丢弃
+                self.idle = []
+                self.pid = os.getpid()
+            searcher = self.idle.pop() if self.idle else None
+        if searcher is None:
+            self.opened += 1
+            return self.ix.searcher()
+        if not searcher.up_to_date():
+            self.refreshed += 1
+            searcher = searcher.refresh()
+        return searcher
+
+    def release(self, searcher):
+        """
+        归还 searcher，空闲数量已满时关闭。
+        """
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.max_idle:
+                self.idle.append(searcher)
+                return
+        searcher.close()
+
+    @contextmanager
+    def searcher(self):
+        """
+        以 with 语句借用 searcher，用完自动归还。
+        """
+        searcher = self.acquire()
+        try:
+            yield searcher
+        finally:
+            self.release(searcher)
+
+    def close(self):
+        """
+        关闭所有空闲的 searcher。
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for searcher in idle:
+            searcher.close()
+
+    def stats(self):
+        """
+        返回池的统计信息。
+        """
+        with self.lock:
+            return {"idle": len(self.idle), "opened": self.opened, "refreshed": self.refreshed}
+
 def commit_index(writer):
     """
     提交索引更改。
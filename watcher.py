@@ -2,10 +2,10 @@ import os
 import logging
 import configparser
 import threading
-import subprocess
 import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from indexer import IndexerService
 
 # 设置日志记录
 def setup_logging(log_file):
@@ -37,72 +37,135 @@ def read_config(config_file, script_dir):
     
     return valid_folders
 
+# 读取 watcher 相关配置，旧配置文件中没有该段时使用默认值
+def read_watcher_config(config_file):
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    return {
+        'debounce_seconds': config.getint('Watcher', 'debounce_seconds', fallback=30),
+        'max_latency_seconds': config.getint('Watcher', 'max_latency_seconds', fallback=300),
+        'full_reconcile_interval': config.getint('Watcher', 'full_reconcile_interval', fallback=3600),
+    }
+
 # 文件变更处理类
+# 事件按路径合并到 pending 中，同一路径只保留最后一次的类型（changed 或 deleted），
+# 由一个分发线程在最后一次事件后 delay 秒、或最早的事件后 max_latency 秒交给常驻索引服务做增量索引。
+# 索引进行中到达的事件同样记录，本次索引结束后再次索引
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, delay, indexer_script):
+    def __init__(self, delay, indexer_service, full_reconcile_interval=3600, max_latency=300):
         self.delay = delay
-        self.indexer_script = indexer_script
-        self.timer = None
-        self.indexing = False
-
-    # def on_any_event(self, event):
-    #     if self.indexing:
-    #         return
-    #     if self.timer:
-    #         self.timer.cancel()
-    #     self.timer = threading.Timer(self.delay, self.start_indexer)
-    #     self.timer.start()
+        self.max_latency = max_latency
+        self.indexer_service = indexer_service
+        self.full_reconcile_interval = full_reconcile_interval
+        self.condition = threading.Condition()
+        self.run_lock = threading.Lock()
+        self.pending = {}
+        self.event_count = 0
+        self.first_event_at = 0
+        self.last_event_at = 0
+        self.last_full_run = 0
+        self.stopped = False
+        self.dispatcher = None
+
+    def start(self):
+        self.dispatcher = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.dispatcher.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.dispatcher:
+            self.dispatcher.join()
+
+    def record(self, path, kind):
+        now = time.monotonic()
+        with self.condition:
+            if not self.pending:
+                self.first_event_at = now
+                # 新事件只会推迟到期时间，只有从空闲变为有待处理事件时才需要唤醒分发线程
+                self.condition.notify()
+            self.pending[path] = kind
+            self.event_count += 1
+            self.last_event_at = now
 
     def on_created(self, event):
-        if self.indexing:
-            return
-        if self.timer:
-            self.timer.cancel()
-        self.timer = threading.Timer(self.delay, self.start_indexer)
-        self.timer.start()
+        self.record(event.src_path, 'changed')
 
     def on_deleted(self, event):
-        if self.indexing:
-            return
-        if self.timer:
-            self.timer.cancel()
-        self.timer = threading.Timer(self.delay, self.start_indexer)
-        self.timer.start()
+        self.record(event.src_path, 'deleted')
 
     def on_modified(self, event):
-        if self.indexing:
+        # 目录的修改事件由其中文件的事件体现
+        if event.is_directory:
             return
-        if self.timer:
-            self.timer.cancel()
-        self.timer = threading.Timer(self.delay, self.start_indexer)
-        self.timer.start()
+        self.record(event.src_path, 'changed')
 
     def on_moved(self, event):
-        if self.indexing:
-            return
-        if self.timer:
-            self.timer.cancel()
-        self.timer = threading.Timer(self.delay, self.start_indexer)
-        self.timer.start()
+        self.record(event.src_path, 'deleted')
+        self.record(event.dest_path, 'changed')
+
+    # 分发线程：等待待处理事件到期后索引，索引在本线程中执行，期间到达的事件留到下一轮
+    # 不能命名为 dispatch，会覆盖 watchdog 分发事件的 FileSystemEventHandler.dispatch(event)
+    def dispatch_loop(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    due = min(self.last_event_at + self.delay, self.first_event_at + self.max_latency)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if self.stopped:
+                    return
+            self.start_indexer()
 
     def start_indexer(self):
-        self.indexing = True
-        logging.info(f"Starting index for changes detected {self.indexer_script}")
-        subprocess.run(["python", self.indexer_script])
-        self.indexing = False
+        # 距离上次全量扫描超过 full_reconcile_interval 时执行全量扫描兜底
+        if time.time() - self.last_full_run >= self.full_reconcile_interval:
+            self.start_full_indexer()
+            return
+
+        with self.run_lock:
+            with self.condition:
+                pending, self.pending = self.pending, {}
+                event_count, self.event_count = self.event_count, 0
+            if not pending:
+                return
+            changed = sorted(path for path, kind in pending.items() if kind == 'changed')
+            deleted = sorted(path for path, kind in pending.items() if kind == 'deleted')
+            logging.info(f"Starting incremental index for {len(changed)} changed and {len(deleted)} deleted paths ({event_count} events)")
+            self.run_job(self.indexer_service.submit_changes(changed, deleted))
+
+    def start_full_indexer(self):
+        with self.run_lock:
+            logging.info("Starting full index")
+            # 全量扫描会覆盖开始前的所有变更；扫描期间到达的变更保留，扫描结束后增量索引
+            with self.condition:
+                self.pending = {}
+                self.event_count = 0
+            self.run_job(self.indexer_service.submit_full())
+            self.last_full_run = time.time()
+
+    # 等待索引任务完成，错误已由索引服务记录
+    def run_job(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(f"Indexing failed: {e}")
 
     def start_indexer_for_new_folders(self, new_folders):
-        self.indexing = True
-        subprocess.run(["python", self.indexer_script])
-        self.indexing = False
+        self.start_full_indexer()
 
 # 监控文件夹
-def monitor_folders(delay, indexer_script, current_folders):
+def monitor_folders(event_handler, current_folders):
     if not current_folders:
         logging.warning("No valid folders found. Exiting...")
         return None
     
-    event_handler = FileChangeHandler(delay, indexer_script)
     observer = Observer()
     for folder in current_folders:
         observer.schedule(event_handler, folder, recursive=True)
@@ -117,8 +180,8 @@ def main():
     setup_logging(log_file)
     
     config_file = os.path.join(script_dir, 'data/config', 'config.ini')
-    indexer_script = os.path.join(script_dir, 'indexer.py')
-    delay = 30  # 30秒延迟
+    watcher_config = read_watcher_config(config_file)
+    delay = watcher_config['debounce_seconds']  # 默认30秒延迟
     
     # 初始化现文件夹列表
     current_folders = read_config(config_file, script_dir)
@@ -126,19 +189,28 @@ def main():
         logging.warning("No valid folders found. Exiting...")
         return
     
+    # 启动常驻索引服务
+    indexer_service = IndexerService(script_dir)
+    indexer_service.start()
+
     # 触发初次索引
-    event_handler = FileChangeHandler(delay, indexer_script)
+    event_handler = FileChangeHandler(delay, indexer_service, watcher_config['full_reconcile_interval'],
+                                      watcher_config['max_latency_seconds'])
+    event_handler.start()
     event_handler.start_indexer_for_new_folders(current_folders)
     logging.info(f"Start index for first time ...... {current_folders}")
 
-    observer = monitor_folders(delay, indexer_script, current_folders)
+    observer = monitor_folders(event_handler, current_folders)
     if not observer:
         return
 
-    # 每隔60秒重新读取配置文件
+    # 每隔60秒重新读取配置文件，并检查是否需要全量扫描兜底
     def reload_config():
         global observer, current_folders
         while True:
+            if time.time() - event_handler.last_full_run >= event_handler.full_reconcile_interval:
+                logging.info("Starting periodic full reconcile")
+                event_handler.start_full_indexer()
             logging.debug("Reloading configuration...")
             new_folders = read_config(config_file, script_dir)
             if new_folders:
@@ -152,11 +224,10 @@ def main():
                     # 更新现文件夹列表
                     current_folders = new_folders
                     # 触发索引
-                    event_handler = FileChangeHandler(delay, indexer_script)
                     event_handler.start_indexer_for_new_folders(current_folders)
                     logging.info(f"Start index for current folders changes ...... {current_folders}")                    
                     # 重新启动监控
-                    observer = monitor_folders(delay, indexer_script, current_folders)
+                    observer = monitor_folders(event_handler, current_folders)
                     if not observer:
                         logging.warning("Failed to reload configuration. Exiting...")
                         return
@@ -171,6 +242,8 @@ def main():
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    event_handler.stop()
+    indexer_service.stop()
 
 if __name__ == "__main__":
     main()
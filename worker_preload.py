@@ -0,0 +1,7 @@
+# 解析进程的 forkserver 预加载模块，见 startup.worker_context
+# forkserver 进程导入本模块时加载解析用到的模块和 jieba 词典，之后 fork 出的解析进程直接共享
+import converters
+import tokenizer
+from startup import load_jieba
+
+load_jieba()